@@ -0,0 +1,91 @@
+import logging
+import time
+
+from jobs import BackgroundJob
+
+logger = logging.getLogger(__name__)
+
+ROLLUP_INTERVAL = 300  # seconds between rollup passes
+DAY = 86400
+WINDOWS = [('Today', 1), ('7 days', 7), ('30 days', 30)]
+
+
+def day_of(timestamp):
+    """UTC day number of an epoch timestamp, the key of the rollup tables."""
+    return int(timestamp) // DAY
+
+
+class Analytics(BackgroundJob):
+    """Append-only subscription events and the daily rollups built from them.
+
+    record() appends to subscription_events: 'checkout' when a Stripe checkout is
+    handed out, 'payment' when one completes, 'manual' for admin activations,
+    'referral_bonus' for bonus days, 'expired' and 'removed'. roll_up() folds every
+    event not yet rolled up into daily_stats (one row per day, kind and plan) and
+    snapshots the active and pending user counts into daily_snapshots.
+    summary() reads at most 30 days of rollup rows, however many users there are.
+    """
+
+    thread_name = 'stats-rollup'
+    title = 'Stats rollup job'
+    interval = ROLLUP_INTERVAL
+
+    def __init__(self, db):
+        super().__init__()
+        self.db = db
+
+    def record(self, kind, user_ids, plan=None, days=None, amount_cents=0, ref=None):
+        """Append one event per user; call inside the transaction that made the change."""
+        if isinstance(user_ids, int):
+            user_ids = [user_ids]
+        now = int(time.time())
+        self.db.executemany("INSERT INTO subscription_events (kind, user_id, plan, days, amount_cents, ref, created_at) "
+                            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                            [(kind, user_id, plan, days, amount_cents, ref, now) for user_id in user_ids])
+
+    def roll_up(self):
+        """Fold events not yet rolled up into daily_stats. Returns the number of events folded."""
+        now = int(time.time())
+        with self.db.transaction():
+            # Events are claimed by flag rather than past an id high-water mark: on Postgres a lower
+            # event_id can commit after a pass has seen a higher one. A concurrent pass waits on the
+            # row locks and then skips the rows this one claimed.
+            events = self.db.fetchall("UPDATE subscription_events SET rolled_up=1 WHERE rolled_up=0 "
+                                      "RETURNING created_at, kind, plan, amount_cents")
+            totals = {}
+            for created_at, kind, plan, amount_cents in events:
+                count, cents = totals.get((day_of(created_at), kind, plan or ''), (0, 0))
+                totals[(day_of(created_at), kind, plan or '')] = (count + 1, cents + amount_cents)
+            self.db.executemany("INSERT INTO daily_stats (day, kind, plan, events, amount_cents) VALUES (?, ?, ?, ?, ?) "
+                                "ON CONFLICT (day, kind, plan) DO UPDATE SET "
+                                "events=daily_stats.events + excluded.events, "
+                                "amount_cents=daily_stats.amount_cents + excluded.amount_cents",
+                                [key + value for key, value in totals.items()])
+            # Both counts are answered from idx_users_status_end without touching the table
+            active = self.db.fetchone("SELECT COUNT(*) FROM users WHERE payment_status='active'")[0]
+            pending = self.db.fetchone("SELECT COUNT(*) FROM users WHERE payment_status='pending'")[0]
+            self.db.execute("INSERT INTO daily_snapshots (day, active, pending, taken_at) VALUES (?, ?, ?, ?) "
+                            "ON CONFLICT (day) DO UPDATE SET active=excluded.active, pending=excluded.pending, "
+                            "taken_at=excluded.taken_at", (day_of(now), active, pending, now))
+        return len(events)
+
+    def summary(self, now=None):
+        """Totals per window from the rollups: {'snapshot': (active, pending, taken_at) or None,
+        'windows': [(label, {(kind, plan): (events, amount_cents)})]}."""
+        today = day_of(now or time.time())
+        longest = max(days for _, days in WINDOWS)
+        rows = self.db.fetchall("SELECT day, kind, plan, events, amount_cents FROM daily_stats WHERE day > ?",
+                                (today - longest,))
+        windows = []
+        for label, days in WINDOWS:
+            totals = {}
+            for day, kind, plan, events, amount in rows:
+                if day > today - days:
+                    count, cents = totals.get((kind, plan), (0, 0))
+                    totals[(kind, plan)] = (count + events, cents + amount)
+            windows.append((label, totals))
+        snapshot = self.db.fetchone("SELECT active, pending, taken_at FROM daily_snapshots ORDER BY day DESC LIMIT 1")
+        return {'snapshot': snapshot, 'windows': windows}
+
+    def run_once(self):
+        self.roll_up()
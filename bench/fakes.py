@@ -0,0 +1,129 @@
+import hashlib
+import hmac
+import itertools
+import json
+import random
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+
+class FakeApiServer:
+    """Local stand-in for api.telegram.org and the Stripe REST API.
+
+    Telegram methods are served at /bot<token>/<method> (point telebot's
+    apihelper.API_URL here) and Checkout Sessions at /v1/checkout/sessions (point
+    stripe.api_base here). Every call sleeps `latency` seconds to mimic the network;
+    a `rate_limit_ratio` share of Telegram sends answers 429 with retry_after=1.
+    """
+
+    def __init__(self, latency=0.05, rate_limit_ratio=0.0, host='127.0.0.1', port=0):
+        self.latency = latency
+        self.rate_limit_ratio = rate_limit_ratio
+        self.calls = Counter()
+        self.lock = threading.Lock()
+        self.message_ids = itertools.count(1000)
+        self.server = ThreadingHTTPServer((host, port), self._handler_class())
+        self.server.daemon_threads = True
+        self.url = f"http://{host}:{self.server.server_address[1]}"
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, name='fake-api', daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def record(self, name):
+        with self.lock:
+            self.calls[name] += 1
+
+    def telegram(self, method, params):
+        if method in ('sendMessage', 'editMessageText') and random.random() < self.rate_limit_ratio:
+            self.record(f"telegram.{method}.429")
+            return 429, {'ok': False, 'error_code': 429, 'description': 'Too Many Requests: retry after 1',
+                         'parameters': {'retry_after': 1}}
+        self.record(f"telegram.{method}")
+        chat_id = int(params.get('chat_id', 0) or 0)
+        if method in ('sendMessage', 'editMessageText'):
+            message_id = int(params.get('message_id') or next(self.message_ids))
+            return 200, {'ok': True, 'result': {'message_id': message_id, 'date': int(time.time()),
+                                                'chat': {'id': chat_id, 'type': 'private'},
+                                                'text': params.get('text', '')}}
+        if method == 'getChat':
+            return 200, {'ok': True, 'result': {'id': chat_id, 'type': 'private',
+                                                'first_name': f"User{chat_id}", 'username': f"user{chat_id}"}}
+        return 200, {'ok': True, 'result': True}
+
+    def checkout_session(self, params):
+        self.record('stripe.checkout.sessions')
+        session_id = f"cs_test_{next(self.message_ids)}"
+        return 200, {'id': session_id, 'object': 'checkout.session', 'url': f"{self.url}/pay/{session_id}",
+                     'expires_at': int(params.get('expires_at', time.time() + 3600)), 'payment_status': 'unpaid'}
+
+    def _handler_class(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.handle_call()
+
+            def do_POST(self):
+                self.handle_call()
+
+            def handle_call(self):
+                url = urlsplit(self.path)
+                params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length) if length else b''
+                if body and 'application/x-www-form-urlencoded' in self.headers.get('Content-Type', ''):
+                    params.update({key: values[-1] for key, values in parse_qs(body.decode()).items()})
+                time.sleep(fake.latency)
+                parts = url.path.strip('/').split('/')
+                if parts[0].startswith('bot') and len(parts) == 2:
+                    status, payload = fake.telegram(parts[1], params)
+                elif url.path == '/v1/checkout/sessions':
+                    status, payload = fake.checkout_session(params)
+                else:
+                    status, payload = 404, {'error': {'message': f"Unknown path {url.path}"}}
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+class StripeWebhookSender:
+    """Builds checkout.session.completed events signed the way Stripe signs webhooks."""
+
+    def __init__(self, secret):
+        self.secret = secret
+        self.event_ids = itertools.count(1)
+
+    def sign(self, payload, timestamp=None):
+        timestamp = int(timestamp or time.time())
+        signature = hmac.new(self.secret.encode(), f"{timestamp}.".encode() + payload, hashlib.sha256).hexdigest()
+        return f"t={timestamp},v1={signature}"
+
+    def checkout_completed(self, user_id, days=7):
+        """(payload bytes, headers) for a completed checkout paying for `days` of access."""
+        event_id = f"evt_loadtest_{next(self.event_ids)}_{user_id}"
+        event = {
+            'id': event_id,
+            'object': 'event',
+            'type': 'checkout.session.completed',
+            'created': int(time.time()),
+            'data': {'object': {'id': f"cs_test_{event_id}", 'object': 'checkout.session',
+                                'metadata': {'user_id': str(user_id), 'days': str(days)}}},
+        }
+        payload = json.dumps(event).encode()
+        return payload, {'Stripe-Signature': self.sign(payload), 'Content-Type': 'application/json'}
@@ -0,0 +1,260 @@
+"""Load test for the bot against local fakes of Telegram and Stripe.
+
+    python -m bench.loadtest --duration 30 --callback-rate 100 --start-rate 10 --payment-rate 5
+
+Runs the real handlers (send_welcome, handle_callback, the /webhook route and
+broadcast_picks) in-process on a throwaway SQLite database, with Telegram and
+Stripe API calls answered by bench.fakes. Traffic is open-loop: operations are
+scheduled at the requested rate whether or not earlier ones finished, and latency
+is measured from the scheduled time, so queueing shows up in the percentiles.
+"""
+import argparse
+import os
+import random
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import telebot
+
+import bot
+import bulk
+import metrics
+import web
+from bench.fakes import FakeApiServer, StripeWebhookSender
+from config import load_config
+
+ADMIN_ID = 1
+USER_BASE = 10_000_000
+PAYER_BASE = 20_000_000
+WEBHOOK_SECRET = 'whsec_loadtest'
+CALLBACK_MIX = [('picks', 3), ('sport_nba', 2), ('sport_nfl', 2), ('sport_mlb', 1), ('status', 2),
+                ('help', 1), ('news', 1), ('back_to_main', 1), ('sub_weekly', 1)]
+BROADCAST_TEXT = "NBA: Lakers +5.5 (-110)\nNFL: Chiefs -3 (-105)\nParlay: Lakers ML + Chiefs -3 (+250)"
+
+
+def loadtest_config(workdir):
+    """Fake credentials and throwaway storage; the real environment and .env are not read."""
+    return load_config({
+        'TELEGRAM_API_TOKEN': '123456:LOADTEST',
+        'STRIPE_API_KEY': 'sk_test_loadtest',
+        'STRIPE_WEBHOOK_SECRET': WEBHOOK_SECRET,
+        'ADMIN_ID': str(ADMIN_ID),
+        'DOMAIN': 'http://localhost',
+        'TELEGRAM_TRANSPORT': 'polling',
+        'DATABASE_URL': f"sqlite:///{os.path.join(workdir, 'loadtest.db')}",
+        'LOG_FILE': os.path.join(workdir, 'loadtest.log'),
+        'LOG_LEVEL': os.getenv('LOADTEST_LOG_LEVEL', 'WARNING'),
+    })
+
+
+class Recorder:
+    def __init__(self, name):
+        self.name = name
+        self.latencies = []
+        self.errors = 0
+        self.lock = threading.Lock()
+
+    def add(self, latency, ok):
+        with self.lock:
+            self.latencies.append(latency)
+            if not ok:
+                self.errors += 1
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def drive(recorder, rate, duration, operation, executor, stop_event):
+    """Submit `operation(i)` `rate` times per second for `duration` seconds (open loop)."""
+    if rate <= 0:
+        return
+    interval = 1.0 / rate
+    start = time.perf_counter()
+    for i in range(int(rate * duration)):
+        scheduled = start + i * interval
+        delay = scheduled - time.perf_counter()
+        if delay > 0 and stop_event.wait(delay):
+            return
+
+        def task(i=i, scheduled=scheduled):
+            try:
+                operation(i)
+                ok = True
+            except Exception:
+                ok = False
+            recorder.add(time.perf_counter() - scheduled, ok)
+        executor.submit(task)
+
+
+def user_payload(user_id):
+    return {'id': user_id, 'is_bot': False, 'first_name': f"User{user_id}", 'username': f"user{user_id}"}
+
+
+def make_message(user_id, text):
+    return telebot.types.Message.de_json({'message_id': random.randint(1, 10 ** 6), 'date': int(time.time()),
+                                          'chat': {'id': user_id, 'type': 'private'},
+                                          'from': user_payload(user_id), 'text': text})
+
+
+def make_callback(user_id, data):
+    return telebot.types.CallbackQuery.de_json({
+        'id': str(random.getrandbits(48)), 'from': user_payload(user_id), 'chat_instance': '1', 'data': data,
+        'message': {'message_id': 1, 'date': int(time.time()), 'chat': {'id': user_id, 'type': 'private'}},
+    })
+
+
+def seed(args):
+    """Active subscribers for the callback traffic and pending checkouts for the payment traffic."""
+    now = int(time.time())
+    bulk.activate_many(bot.db, {USER_BASE + i: 7 for i in range(args.subscribers)}, payment_link=None)
+    payers = int(args.payment_rate * args.duration) + 1
+    bot.db.executemany('upsert_pending', [(PAYER_BASE + i, 'pending', 'https://checkout.invalid', 'week', now + 3600)
+                                          for i in range(payers)])
+
+
+def histogram_summary(histogram):
+    """(count, total seconds, approximate p99 upper bound) across all label sets of a metrics.Histogram."""
+    with histogram.lock:
+        series = [list(values) for values in histogram.series.values()]
+    if not series:
+        return 0, 0.0, 0.0
+    buckets = [sum(values[i] for values in series) for i in range(len(histogram.buckets) + 1)]
+    count, total = sum(buckets), sum(values[-1] for values in series)
+    seen, p99 = 0, float('inf')
+    for bound, n in zip(histogram.buckets + (float('inf'),), buckets):
+        seen += n
+        if seen >= 0.99 * count:
+            p99 = bound
+            break
+    return count, total, p99
+
+
+def wait_until_idle(sql, timeout):
+    """Poll until `sql` returns no row (the background work it checks for is finished)."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if not bot.db.fetchone(sql):
+            return True
+        time.sleep(0.5)
+    return False
+
+
+def report(recorders, elapsed, fake):
+    print(f"\n{'scenario':<12}{'ops':>8}{'errors':>8}{'ops/s':>10}{'p50 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for recorder in recorders:
+        latencies = recorder.latencies
+        if not latencies:
+            continue
+        print(f"{recorder.name:<12}{len(latencies):>8}{recorder.errors:>8}{len(latencies) / elapsed:>10.1f}"
+              f"{percentile(latencies, 0.5) * 1000:>10.1f}{percentile(latencies, 0.99) * 1000:>10.1f}"
+              f"{max(latencies) * 1000:>10.1f}")
+
+    jobs = bot.db.fetchall("SELECT j.job_id, j.total, j.created_at, j.finished_at, "
+                           "SUM(CASE WHEN r.state = 'sent' THEN 1 ELSE 0 END) FROM broadcast_jobs j "
+                           "JOIN broadcast_recipients r ON r.job_id = j.job_id GROUP BY j.job_id")
+    for job_id, total, created_at, finished_at, sent in jobs:
+        if finished_at:
+            took = max(finished_at - created_at, 1)
+            print(f"\nbroadcast #{job_id}: {sent}/{total} delivered in ~{took}s ({sent / took:.1f} msg/s)")
+        else:
+            print(f"\nbroadcast #{job_id}: {sent}/{total} delivered, not finished")
+
+    events = dict(bot.db.fetchall("SELECT status, COUNT(*) FROM stripe_events GROUP BY status"))
+    print(f"stripe events: {events or 'none'}")
+
+    print("\ndatabase")
+    for name, label in (('db_begin_seconds', 'write lock wait (BEGIN IMMEDIATE)'),
+                        ('db_pool_wait_seconds', 'connection pool wait'),
+                        ('db_query_seconds', 'statements')):
+        count, total, p99 = histogram_summary(metrics.histogram(name, ''))
+        print(f"  {label:<36}{count:>8} calls  {total:>8.2f}s total  p99 <= {p99 * 1000:g} ms")
+    lock_errors = sum(metrics.counter('db_lock_errors_total', '').values.values())
+    print(f"  {'database is locked errors':<36}{lock_errors:>8}")
+
+    print("\nfake API calls")
+    for name, count in sorted(fake.calls.items()):
+        print(f"  {name:<36}{count:>8}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--duration', type=float, default=30, help='seconds of traffic per scenario')
+    parser.add_argument('--start-rate', type=float, default=5, help='/start messages per second')
+    parser.add_argument('--callback-rate', type=float, default=50, help='button presses per second')
+    parser.add_argument('--payment-rate', type=float, default=2, help='Stripe checkout.session.completed webhooks per second')
+    parser.add_argument('--broadcasts', type=int, default=1, help='admin picks broadcasts, spread over the run')
+    parser.add_argument('--users', type=int, default=2000, help='distinct users sending /start and callbacks')
+    parser.add_argument('--subscribers', type=int, default=500, help='users seeded with an active subscription')
+    parser.add_argument('--workers', type=int, default=32, help='concurrent handler threads')
+    parser.add_argument('--telegram-latency', type=float, default=0.05, help='seconds each fake API call takes')
+    parser.add_argument('--rate-limit-ratio', type=float, default=0.0, help='share of Telegram sends answered with 429')
+    parser.add_argument('--drain-timeout', type=float, default=120, help='seconds to wait for broadcasts to finish')
+    parser.add_argument('--workdir', help='directory for the database and log (default: a new temp dir)')
+    args = parser.parse_args(argv)
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='loadtest-')
+    fake = FakeApiServer(latency=args.telegram_latency, rate_limit_ratio=args.rate_limit_ratio).start()
+
+    app = web.create_app(loadtest_config(workdir))
+    telebot.apihelper.API_URL = fake.url + '/bot{0}/{1}'
+    bot.get_stripe().api_base = fake.url
+    bot.start_background(bot.broadcast_queue)
+    seed(args)
+    sender = StripeWebhookSender(WEBHOOK_SECRET)
+    routes, weights = zip(*CALLBACK_MIX)
+
+    def start_op(i):
+        bot.send_welcome(make_message(USER_BASE + random.randrange(args.users), '/start'))
+
+    def callback_op(i):
+        data = random.choices(routes, weights)[0]
+        bot.handle_callback(make_callback(USER_BASE + random.randrange(args.users), data))
+
+    def payment_op(i):
+        payload, headers = sender.checkout_completed(PAYER_BASE + i)
+        response = app.test_client().post('/webhook', data=payload, headers=headers)
+        if response.status_code != 200:
+            raise RuntimeError(f"webhook answered {response.status_code}")
+
+    def broadcast_op(i):
+        bot.broadcast_picks(make_message(ADMIN_ID, BROADCAST_TEXT))
+
+    recorders = {name: Recorder(name) for name in ('start', 'callback', 'payment', 'broadcast')}
+    scenarios = [
+        (recorders['start'], args.start_rate, start_op),
+        (recorders['callback'], args.callback_rate, callback_op),
+        (recorders['payment'], args.payment_rate, payment_op),
+        (recorders['broadcast'], args.broadcasts / args.duration, broadcast_op),
+    ]
+    stop_event = threading.Event()
+    print(f"Running {args.duration:g}s of traffic against {fake.url} (workdir {workdir})")
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.workers, thread_name_prefix='loadtest') as executor:
+        drivers = [threading.Thread(target=drive, args=(recorder, rate, args.duration, op, executor, stop_event))
+                   for recorder, rate, op in scenarios]
+        for driver in drivers:
+            driver.start()
+        try:
+            for driver in drivers:
+                driver.join()
+        except KeyboardInterrupt:
+            stop_event.set()
+    elapsed = time.perf_counter() - started
+
+    if not wait_until_idle("SELECT 1 FROM broadcast_jobs WHERE status != 'done' LIMIT 1", args.drain_timeout):
+        print(f"Broadcasts still sending after {args.drain_timeout:g}s")
+    if not wait_until_idle("SELECT 1 FROM stripe_events WHERE status IN ('queued', 'processing') LIMIT 1", 30):
+        print("Stripe events still queued after 30s")
+    report(list(recorders.values()), elapsed, fake)
+    bot.shutdown()
+    fake.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,259 +1,426 @@
 import telebot
-import sqlite3
-from datetime import datetime, timedelta
-from flask import Flask, request
-import stripe
+import functools
+from datetime import datetime
 import threading
+import time
 import os
+import signal
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 import logging
-from dotenv import load_dotenv
-
-# Load environment variables
-load_dotenv()
-API_TOKEN = os.getenv('TELEGRAM_API_TOKEN', '7900055310:AAGswliYMf8-ZA8BhhQpES1Ju2oQollvko4')
-ADMIN_ID = int(os.getenv('ADMIN_ID', 7933828542))
-STRIPE_API_KEY = os.getenv('STRIPE_API_KEY')
-WEBHOOK_SECRET = os.getenv('STRIPE_WEBHOOK_SECRET')
+import metrics
+from broadcast import BroadcastEngine, BroadcastQueue
+import bulk
+from cache import MISSING, TTLCache
+from config import load_config
+import db as database
+import migrations
+from scheduler import ExpirySweeper
+from stripe_events import StripeEventQueue
+from transport import UpdateDispatcher, instrument_telegram_requests, poll_updates
+from profiles import ProfileCache
+from picks import PicksStore
+from referrals import ReferralEngine
+from analytics import Analytics
+from leases import LeaderOnly
+from steps import DatabaseHandlerBackend
+from throttle import InFlightDeduper, KeyedRateLimiter
+from router import CallbackContext, CallbackRouter
+from logconfig import setup_logging, stop_logging
+
 TEST_USER_ID = 7761809923  # Test user for picks
-DOMAIN = os.getenv('DOMAIN', 'http://localhost:4242')  # Default to localhost for testing
-
-# Validate required environment variables
-required_vars = {'TELEGRAM_API_TOKEN': API_TOKEN, 'STRIPE_API_KEY': STRIPE_API_KEY, 'STRIPE_WEBHOOK_SECRET': WEBHOOK_SECRET}
-for name, value in required_vars.items():
-    if not value:
-        raise ValueError(f"Missing required environment variable: {name}")
-
-# Initialize bot and Flask app
-bot = telebot.TeleBot(API_TOKEN)
-app = Flask(__name__)
-stripe.api_key = STRIPE_API_KEY
-
-# Logging configuration
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[logging.FileHandler('bot.log'), logging.StreamHandler()]
-)
+SUBSCRIBERS_PAGE_SIZE = 20
+CHECKOUT_TTL = 23 * 3600  # Stripe allows checkout sessions to live between 30 minutes and 24 hours
+CHECKOUT_REUSE_MARGIN = 600  # don't hand out a session that expires within this many seconds
+STRIPE_WORKERS = 4
+STRIPE_MAX_PENDING = 32  # checkout creations queued or running before new ones are turned away
+SHUTDOWN_TIMEOUT = 20  # seconds each background thread gets to finish on shutdown
+NEGATIVE_CACHE_TTL = 10  # seconds a user without a running subscription stays cached
+
+# Configuration, clients and services, built by setup(). Importing this module reads no
+# environment, opens no files and creates no clients.
+config = None
+bot = None
+db = None
+broadcaster = None
+broadcast_queue = None
+subscription_cache = None
+expiry_sweeper = None
+stripe_events = None
+update_dispatcher = None
+profile_cache = None
+picks_store = None
+referrals = None
+analytics = None
+setup_lock = threading.Lock()
+
+callback_limiter = KeyedRateLimiter()
+stripe_executor = ThreadPoolExecutor(max_workers=STRIPE_WORKERS, thread_name_prefix='stripe')
+checkout_slots = threading.BoundedSemaphore(STRIPE_MAX_PENDING)
+checkout_lock = threading.Lock()
+checkouts_in_flight = set()
+checkout_cache = TTLCache(maxsize=10000, ttl=CHECKOUT_TTL)
+callback_deduper = InFlightDeduper()
+callbacks = CallbackRouter()
+shutdown_event = threading.Event()
+background_services = []
+background_threads = []
+
 logger = logging.getLogger(__name__)
 
+# Metrics, served at /metrics
+CALLBACK_SECONDS = metrics.histogram('callback_seconds', 'Callback query handling latency by route')
+CALLBACK_ERRORS = metrics.counter('callback_errors_total', 'Callback handlers that raised, by route')
+CALLBACKS_REJECTED = metrics.counter('callbacks_rejected_total', 'Callback queries dropped before dispatch, by reason')
+STRIPE_SECONDS = metrics.histogram('stripe_request_seconds', 'Stripe API call latency')
+STRIPE_ERRORS = metrics.counter('stripe_request_errors_total', 'Stripe API calls that failed')
+
+# Setup
+def setup(cfg=None):
+    """Build the Telegram client, database and services from `cfg` (default: load_config()).
+
+    Every entry point calls this first: the bot and worker processes below, web.create_app,
+    scripts and tests. Nothing starts running; background services are started separately.
+    Safe to call more than once.
+    """
+    global config, bot, db, broadcaster, broadcast_queue, subscription_cache, expiry_sweeper
+    global stripe_events, update_dispatcher, profile_cache, picks_store, referrals, analytics
+    with setup_lock:
+        if config is not None:
+            return config
+        cfg = cfg or load_config()
+        setup_logging(level=cfg.log_level, path=cfg.log_file, max_bytes=cfg.log_max_bytes, backups=cfg.log_backups)
+        db = database.connect(cfg.database_url)
+        bot = make_bot(cfg, db)
+        broadcaster = BroadcastEngine(bot.send_message)
+        broadcast_queue = BroadcastQueue(db, broadcaster, bot)
+        subscription_cache = TTLCache(maxsize=cfg.subscription_cache_size, ttl=cfg.subscription_cache_ttl)
+        analytics = Analytics(db)
+        expiry_sweeper = ExpirySweeper(db, broadcaster, on_expired=subscription_cache.invalidate_many,
+                                       analytics=analytics)
+        stripe_events = StripeEventQueue(db, handlers={'checkout.session.completed': apply_checkout_completed})
+        update_dispatcher = UpdateDispatcher(bot, max_workers=cfg.update_workers)
+        profile_cache = ProfileCache(db, bot)
+        picks_store = PicksStore(db)
+        referrals = ReferralEngine(db, broadcaster, on_rewarded=subscription_cache.invalidate_many,
+                                   analytics=analytics)
+        config = cfg
+        return config
+
+def make_bot(cfg, db):
+    """Telegram client with this module's handlers registered."""
+    # Pending next steps live in the database so whichever process gets the reply can handle it
+    next_step_backend = None
+    if cfg.next_step_store == 'database':
+        next_step_backend = DatabaseHandlerBackend(db, [apply_referral_code, broadcast_picks, remove_subscriber,
+                                                        manually_activate_subscription, bulk_import])
+    # In webhook mode updates already run on update_dispatcher's pool, so the bot handles them inline
+    telegram = telebot.TeleBot(cfg.api_token, threaded=cfg.telegram_transport != 'webhook',
+                               num_threads=cfg.update_workers, next_step_backend=next_step_backend)
+    telegram.register_message_handler(send_welcome, commands=['start'])
+    telegram.register_callback_query_handler(handle_callback, func=lambda call: True)
+    instrument_telegram_requests()
+    return telegram
+
+@functools.lru_cache(maxsize=None)
+def get_stripe():
+    """The stripe module, imported and configured on first use; the worker process never loads it."""
+    import stripe
+    stripe.api_key = config.stripe_api_key
+    stripe.default_http_client = stripe.http_client.RequestsClient(timeout=config.stripe_timeout)
+    return stripe
+
 # Database functions
 def init_db():
-    with sqlite3.connect('users.db') as conn:
-        c = conn.cursor()
-        c.execute('''CREATE TABLE IF NOT EXISTS users 
-                     (user_id INTEGER PRIMARY KEY, 
-                      subscription_end TEXT,
-                      payment_status TEXT,
-                      payment_link TEXT,
-                      referral_code TEXT,
-                      referred_by INTEGER)''')
-        conn.commit()
-    logger.info("Database initialized or updated")
+    version = migrations.migrate(db)
+    for sql, plan in migrations.check_query_plans(db):
+        logger.warning(f"Query not using its index: {sql} -> {plan}")
+    picks_store.reload()
+    logger.info(f"Database initialized or updated (schema version {version})")
+
+def format_timestamp(ts, fmt='%Y-%m-%d %H:%M:%S'):
+    return datetime.fromtimestamp(ts).strftime(fmt) if ts else "N/A"
+
+def get_subscription_end(user_id):
+    """Parsed subscription end for a user (None if never subscribed), served from subscription_cache."""
+    end_date = subscription_cache.get(user_id)
+    if end_date is not MISSING:
+        return end_date
+    result = db.fetchone('subscription_end', (user_id,))
+    end_date = datetime.fromtimestamp(result[0]) if result and result[0] else None
+    # Another process may apply a payment at any moment, so only briefly remember non-subscribers
+    subscription_cache.set(user_id, end_date, ttl=None if end_date and end_date > datetime.now() else NEGATIVE_CACHE_TTL)
+    return end_date
 
 def is_subscribed(user_id):
     try:
-        with sqlite3.connect('users.db') as conn:
-            c = conn.cursor()
-            c.execute("SELECT subscription_end FROM users WHERE user_id=?", (user_id,))
-            result = c.fetchone()
-        if result and result[0]:
-            return datetime.strptime(result[0], '%Y-%m-%d %H:%M:%S') > datetime.now()
-        return False
+        end_date = get_subscription_end(user_id)
+        return end_date is not None and end_date > datetime.now()
     except Exception as e:
         logger.error(f"Error checking subscription for user {user_id}: {e}")
         return False
 
-def update_subscription(user_id, days, payment_link="Manually Activated"):
+def activate_subscription(user_id, days, payment_link="Manually Activated", kind='manual', plan=None, amount_cents=0,
+                          ref=None):
+    """Add `days` to the user's subscription and log it to subscription_events ('payment' for Stripe,
+    'manual' for admins). A running subscription is extended and banked referral bonus days are added.
+
+    Returns the new end date; database errors propagate so the Stripe consumer can retry the event.
+    """
+    now = int(time.time())
+    with db.transaction():
+        end = db.fetchone('activate_subscription', (user_id, now + days * 86400, payment_link, now, now, days * 86400))[0]
+        analytics.record(kind, user_id, plan=plan, days=days, amount_cents=amount_cents, ref=ref)
+    end_date = datetime.fromtimestamp(end)
+    subscription_cache.invalidate(user_id)
+    logger.info(f"Subscription updated for user {user_id} for {days} days")
+    return end_date
+
+def send_activation_notice(user_id, end_date):
     try:
-        end_date = datetime.now() + timedelta(days=days)
-        with sqlite3.connect('users.db') as conn:
-            c = conn.cursor()
-            c.execute("INSERT OR REPLACE INTO users (user_id, subscription_end, payment_status, payment_link) VALUES (?, ?, ?, ?)",
-                      (user_id, end_date.strftime('%Y-%m-%d %H:%M:%S'), 'active', payment_link))
-            conn.commit()
         bot.send_message(user_id, f"🏆 Your subscription has been activated! It’s active until {end_date.strftime('%Y-%m-%d')}! 🚀")
-        logger.info(f"Subscription updated for user {user_id} for {days} days")
-        return end_date
+    except Exception as e:
+        logger.error(f"Error sending activation notice to {user_id}: {e}")
+
+def update_subscription(user_id, days, payment_link="Manually Activated"):
+    try:
+        end_date = activate_subscription(user_id, days, payment_link)
     except Exception as e:
         logger.error(f"Error updating subscription for user {user_id}: {e}")
         return None
+    send_activation_notice(user_id, end_date)
+    return end_date
 
 def set_test_user_subscription(user_id):
     try:
         end_date = datetime.strptime('2025-12-31 23:59:59', '%Y-%m-%d %H:%M:%S')
-        with sqlite3.connect('users.db') as conn:
-            c = conn.cursor()
-            c.execute("INSERT OR REPLACE INTO users (user_id, subscription_end, payment_status) VALUES (?, ?, ?)",
-                      (user_id, end_date.strftime('%Y-%m-%d %H:%M:%S'), 'active'))
-            conn.commit()
+        db.execute("INSERT INTO users (user_id, subscription_end, payment_status) VALUES (?, ?, ?) "
+                   "ON CONFLICT (user_id) DO UPDATE SET subscription_end=excluded.subscription_end, "
+                   "payment_status=excluded.payment_status",
+                   (user_id, int(end_date.timestamp()), 'active'))
+        subscription_cache.invalidate(user_id)
         logger.info(f"Test user {user_id} automatically subscribed until {end_date}")
     except Exception as e:
         logger.error(f"Error setting test user subscription for {user_id}: {e}")
 
-def clean_expired_subscriptions():
-    try:
-        with sqlite3.connect('users.db') as conn:
-            c = conn.cursor()
-            c.execute("UPDATE users SET payment_status='expired' WHERE subscription_end < ? AND payment_status='active'",
-                      (datetime.now().strftime('%Y-%m-%d %H:%M:%S'),))
-            conn.commit()
-        logger.info("Expired subscriptions cleaned")
-    except Exception as e:
-        logger.error(f"Error cleaning expired subscriptions: {e}")
-
 def get_all_subscribers():
     try:
-        with sqlite3.connect('users.db') as conn:
-            c = conn.cursor()
-            c.execute("SELECT user_id FROM users WHERE payment_status='active'")
-            return [row[0] for row in c.fetchall()]
+        return [row[0] for row in db.fetchall('active_subscribers')]
     except Exception as e:
         logger.error(f"Error fetching subscribers: {e}")
         return []
 
-def get_subscriber_details():
+def get_subscriber_page(after_id=None, before_id=None, limit=SUBSCRIBERS_PAGE_SIZE):
+    """One keyset-paginated page of users: (rows, has_prev, has_next).
+
+    Pass after_id to page forward from the last id shown, before_id to page back from the first.
+    Each row is (user_id, name, username, subscription_end, payment_status) with names from profile_cache.
+    """
     try:
-        with sqlite3.connect('users.db') as conn:
-            c = conn.cursor()
-            c.execute("SELECT user_id, subscription_end, payment_status FROM users")
-            subscribers = c.fetchall()
-        
-        subscriber_info = []
-        for sub_id, sub_end, status in subscribers:
-            try:
-                user = bot.get_chat(sub_id)
-                name = user.first_name or "Unknown"
-                username = f"@{user.username}" if user.username else "No Username"
-                subscriber_info.append((sub_id, name, username, sub_end, status))
-            except Exception as e:
-                logger.error(f"Error fetching Telegram info for user {sub_id}: {e}")
-                subscriber_info.append((sub_id, "Unknown", "No Username", sub_end, status))
-        return subscriber_info
+        if before_id is not None:
+            rows = db.fetchall("SELECT user_id, subscription_end, payment_status FROM users WHERE user_id < ? "
+                               "ORDER BY user_id DESC LIMIT ?", (before_id, limit + 1))
+            has_prev, has_next = len(rows) > limit, True
+            rows = rows[:limit][::-1]
+        else:
+            rows = db.fetchall("SELECT user_id, subscription_end, payment_status FROM users WHERE user_id > ? "
+                               "ORDER BY user_id LIMIT ?", (after_id if after_id is not None else -1, limit + 1))
+            has_prev, has_next = after_id is not None, len(rows) > limit
+            rows = rows[:limit]
+
+        profiles = profile_cache.get_many(sub_id for sub_id, _, _ in rows)
+        page = []
+        for sub_id, sub_end, status in rows:
+            first_name, username = profiles.get(sub_id, (None, None))
+            page.append((sub_id, first_name or "Unknown", f"@{username}" if username else "No Username",
+                         format_timestamp(sub_end), status))
+        return page, has_prev, has_next
     except Exception as e:
-        logger.error(f"Error fetching subscriber details: {e}")
-        return []
+        logger.error(f"Error fetching subscriber page: {e}")
+        return [], False, False
 
 def get_user_subscription(user_id):
     try:
-        with sqlite3.connect('users.db') as conn:
-            c = conn.cursor()
-            c.execute("SELECT subscription_end, payment_status FROM users WHERE user_id=?", (user_id,))
-            return c.fetchone()
+        return db.fetchone('user_subscription', (user_id,))
     except Exception as e:
         logger.error(f"Error fetching subscription for user {user_id}: {e}")
         return None
 
 def generate_referral_code(user_id):
-    code = f"REF{user_id}{datetime.now().strftime('%H%M%S')}"
+    """The user's stable referral code (minted on first request)."""
     try:
-        with sqlite3.connect('users.db') as conn:
-            c = conn.cursor()
-            c.execute("UPDATE users SET referral_code=? WHERE user_id=?", (code, user_id))
-            conn.commit()
-        return code
+        return referrals.code_for(user_id)
     except Exception as e:
         logger.error(f"Error generating referral code for user {user_id}: {e}")
         return None
 
 def use_referral_code(user_id, code):
+    """Record the referral; the referrer is notified in the background."""
     try:
-        with sqlite3.connect('users.db') as conn:
-            c = conn.cursor()
-            c.execute("SELECT user_id FROM users WHERE referral_code=?", (code,))
-            referrer = c.fetchone()
-            if referrer and referrer[0] != user_id:
-                c.execute("UPDATE users SET referred_by=? WHERE user_id=?", (referrer[0], user_id))
-                conn.commit()
-                bot.send_message(referrer[0], "🎁 Someone used your referral code! You’ll get a bonus soon!")
-                bot.send_message(user_id, "✅ Referral code applied! Enjoy your subscription!")
-                logger.info(f"User {user_id} used referral code {code} from {referrer[0]}")
-                return True
-            return False
+        return referrals.join(user_id, code) is not None
     except Exception as e:
         logger.error(f"Error using referral code for user {user_id}: {e}")
         return False
 
 # Stripe Checkout Session Creation
 def create_checkout_session(user_id, period):
+    """Returns (checkout url, expires_at epoch seconds), or None on error."""
     price = 5000 if period == "week" else 8000  # In cents
     days = 7 if period == "week" else 14
     try:
-        session = stripe.checkout.Session.create(
-            payment_method_types=['card'],
-            line_items=[{
-                'price_data': {
-                    'currency': 'usd',
-                    'unit_amount': price,
-                    'product_data': {
-                        'name': f'{period.capitalize()} VIP Subscription',
+        with STRIPE_SECONDS.time(call='checkout_session_create'):
+            session = get_stripe().checkout.Session.create(
+                payment_method_types=['card'],
+                line_items=[{
+                    'price_data': {
+                        'currency': 'usd',
+                        'unit_amount': price,
+                        'product_data': {
+                            'name': f'{period.capitalize()} VIP Subscription',
+                        },
                     },
-                },
-                'quantity': 1,
-            }],
-            mode='payment',
-            success_url=f'{DOMAIN}/success',
-            cancel_url=f'{DOMAIN}/cancel',
-            metadata={'user_id': str(user_id), 'days': str(days)}
-        )
-        return session.url
+                    'quantity': 1,
+                }],
+                mode='payment',
+                success_url=f'{config.domain}/success',
+                cancel_url=f'{config.domain}/cancel',
+                metadata={'user_id': str(user_id), 'days': str(days), 'plan': period},
+                expires_at=int(time.time()) + CHECKOUT_TTL
+            )
+        return session.url, session.expires_at
     except Exception as e:
+        STRIPE_ERRORS.inc(call='checkout_session_create')
         logger.error(f"Error creating checkout session for user {user_id}: {e}")
         return None
 
+def get_pending_checkout(user_id, period):
+    """URL of the user's pending checkout for this plan if Stripe will still accept it, else None."""
+    cached = checkout_cache.get((user_id, period), None)
+    if cached:
+        return cached
+    row = db.fetchone('pending_checkout', (user_id,))
+    if row and row[0] and row[1] == period and (row[2] or 0) > time.time() + CHECKOUT_REUSE_MARGIN:
+        remember_checkout(user_id, period, row[0], row[2])
+        return row[0]
+    return None
+
+def remember_checkout(user_id, period, checkout_url, expires_at):
+    checkout_cache.set((user_id, period), checkout_url, ttl=expires_at - time.time() - CHECKOUT_REUSE_MARGIN)
+
+def forget_checkouts(user_id):
+    checkout_cache.invalidate_many([(user_id, "week"), (user_id, "bi-weekly")])
+
 # Bot utility functions
-def send_payment_link(user_id, period):
-    if is_subscribed(user_id):
+def send_payment_link(user_id, period, subscribed):
+    """Send a checkout link, reusing a pending session or creating one on stripe_executor.
+
+    `subscribed` is the status already resolved for this update (CallbackContext.subscribed).
+    Creating a session never blocks the handler thread: the user gets a placeholder message
+    that is edited into the link (or an error) when Stripe answers or times out.
+    """
+    if subscribed:
         bot.send_message(user_id, "🏆 You’re already a VIP member! Enjoy your perks!")
         return
-    price = 50 if period == "week" else 80
-    checkout_url = create_checkout_session(user_id, period)
-    if not checkout_url:
-        bot.send_message(user_id, "❌ Error generating payment link. Try again later.")
+    try:
+        checkout_url = get_pending_checkout(user_id, period)
+        if checkout_url:
+            bot.send_message(user_id, checkout_text(period), reply_markup=checkout_markup(period, checkout_url))
+            return
+    except Exception as e:
+        logger.error(f"Error reading pending checkout for user {user_id}: {e}")
+
+    key = (user_id, period)
+    with checkout_lock:
+        if key in checkouts_in_flight:
+            return
+        if not checkout_slots.acquire(blocking=False):
+            bot.send_message(user_id, "⏳ Payments are busy right now. Please try again in a moment.")
+            return
+        checkouts_in_flight.add(key)
+    try:
+        placeholder = bot.send_message(user_id, "⏳ Preparing your secure checkout link...")
+        future = stripe_executor.submit(create_checkout_session, user_id, period)
+    except Exception as e:
+        finish_checkout(key)
+        logger.error(f"Error starting checkout for user {user_id}: {e}")
         return
+    future.add_done_callback(lambda f: deliver_checkout(user_id, period, placeholder, f))
+
+def deliver_checkout(user_id, period, placeholder, future):
     try:
-        with sqlite3.connect('users.db') as conn:
-            c = conn.cursor()
-            c.execute("INSERT OR REPLACE INTO users (user_id, payment_status, payment_link) VALUES (?, ?, ?)",
-                      (user_id, 'pending', checkout_url))
-            conn.commit()
-        markup = telebot.types.InlineKeyboardMarkup()
-        markup.add(telebot.types.InlineKeyboardButton(f"Pay ${price}/{period}", url=checkout_url))
-        markup.add(telebot.types.InlineKeyboardButton("🔙 Back to Menu", callback_data='back_to_main'))
-        bot.send_message(user_id, f"💰 Unlock premium sports picks for just ${price}/{period}! Click below:", reply_markup=markup)
+        checkout = None if future.exception() else future.result()
+        if not checkout:
+            bot.edit_message_text("❌ Error generating payment link. Try again later.", user_id, placeholder.message_id,
+                                  reply_markup=get_back_button())
+            return
+        checkout_url, expires_at = checkout
+        with db.transaction():
+            db.execute('upsert_pending', (user_id, 'pending', checkout_url, period, expires_at))
+            analytics.record('checkout', user_id, plan=period)
+        subscription_cache.invalidate(user_id)
+        remember_checkout(user_id, period, checkout_url, expires_at)
+        bot.edit_message_text(checkout_text(period), user_id, placeholder.message_id,
+                              reply_markup=checkout_markup(period, checkout_url))
         logger.info(f"Pending subscription set for user {user_id} with {period} plan")
     except Exception as e:
         logger.error(f"Error setting pending subscription for user {user_id}: {e}")
+    finally:
+        finish_checkout((user_id, period))
 
-# Preformatted picks template (optional)
-def format_picks(nba_picks, nfl_picks, mlb_picks, parlay_pick):
-    current_date = datetime.now().strftime('%Y-%m-%d')
-    formatted_picks = f"📢 Exclusive Sports Picks – {current_date}\n\n"
-    formatted_picks += "🔥 Top Analyst Picks 🔥\n\n"
-    formatted_picks += "🏀 NBA Picks\n"
-    for pick in nba_picks:
-        formatted_picks += f"✅ {pick}\n"
-    formatted_picks += "\n"
-    formatted_picks += "🏈 NFL Picks\n"
-    for pick in nfl_picks:
-        formatted_picks += f"✅ {pick}\n"
-    formatted_picks += "\n"
-    formatted_picks += "⚾ MLB Picks\n"
-    for pick in mlb_picks:
-        formatted_picks += f"✅ {pick}\n"
-    formatted_picks += "\n"
-    formatted_picks += f"🎯 Expert Parlay of the Day\n"
-    formatted_picks += f"💰 {parlay_pick}\n\n"
-    formatted_picks += "🔔 Risk Management Tip: Always bet responsibly and manage your bankroll wisely.\n\n"
-    formatted_picks += "🚀 Stay ahead. Stay winning!"
-    return formatted_picks
+def finish_checkout(key):
+    with checkout_lock:
+        checkouts_in_flight.discard(key)
+    checkout_slots.release()
+
+def checkout_text(period):
+    price = 50 if period == "week" else 80
+    return f"💰 Unlock premium sports picks for just ${price}/{period}! Click below:"
 
-SPORTS_PICKS = {
-    'nba': ["Lakers +5.5 (-110)", "Warriors ML (-120)"],
-    'nfl': ["Chiefs -3 (-105)", "Bills Over 48.5 (-115)"],
-    'mlb': ["Yankees ML (-130)", "Dodgers -1.5 (+150)"],
-    'parlay': "Lakers ML + Chiefs -3 (+250)"
+def checkout_markup(period, checkout_url):
+    price = 50 if period == "week" else 80
+    markup = telebot.types.InlineKeyboardMarkup()
+    markup.add(telebot.types.InlineKeyboardButton(f"Pay ${price}/{period}", url=checkout_url))
+    markup.add(telebot.types.InlineKeyboardButton("🔙 Back to Menu", callback_data='back_to_main'))
+    return markup
+
+# Picks rendering
+SPORT_TITLES = {
+    'nba': "🏀 NBA Picks",
+    'nfl': "🏈 NFL Picks",
+    'mlb': "⚾ MLB Picks",
+    'nhl': "🏒 NHL Picks",
+    'tennis': "🎾 Tennis Picks",
 }
 
+def format_picks(sport_picks, parlay=None):
+    lines = [f"📢 Exclusive Sports Picks – {sport_picks.pick_date}", "", "🔥 Top Analyst Picks 🔥", "",
+             SPORT_TITLES[sport_picks.sport]]
+    lines.extend(f"✅ {pick}" for pick in sport_picks.lines)
+    lines.append("")
+    if parlay and parlay.lines:
+        lines += ["🎯 Expert Parlay of the Day"] + [f"💰 {pick}" for pick in parlay.lines] + [""]
+    lines += ["🔔 Risk Management Tip: Always bet responsibly and manage your bankroll wisely.", "",
+              "🚀 Stay ahead. Stay winning!"]
+    return "\n".join(lines)
+
+@functools.lru_cache(maxsize=64)
+def render_picks(sport_picks, parlay):
+    """Formatted picks text, rendered once per published version (entries carry sport, date and version)."""
+    return format_picks(sport_picks, parlay)
+
+def parse_picks_input(text):
+    """Group 'NBA: Lakers +5.5' style lines by sport ('parlay' included); other lines are broadcast only."""
+    by_sport = {}
+    for line in text.splitlines():
+        prefix, sep, pick = line.partition(':')
+        sport = prefix.strip().lower()
+        if sep and pick.strip() and (sport in SPORT_TITLES or sport == 'parlay'):
+            by_sport.setdefault(sport, []).append(pick.strip())
+    return by_sport
+
+# Static keyboards are built and serialized once; telebot sends pre-serialized markup as-is
+@functools.lru_cache(maxsize=None)
 def get_sports_menu():
     markup = telebot.types.InlineKeyboardMarkup(row_width=2)
     markup.add(
@@ -264,12 +431,16 @@ def get_sports_menu():
         telebot.types.InlineKeyboardButton("🎾 Tennis", callback_data='sport_tennis'),
         telebot.types.InlineKeyboardButton("🔙 Back to Menu", callback_data='back_to_main')
     )
-    return markup
+    return markup.to_json()
 
 # Menu generation
 def get_user_menu(user_id):
+    return build_user_menu(is_subscribed(user_id))
+
+@functools.lru_cache(maxsize=None)
+def build_user_menu(subscribed):
     markup = telebot.types.InlineKeyboardMarkup()
-    if is_subscribed(user_id):
+    if subscribed:
         markup.add(telebot.types.InlineKeyboardButton("🏀 Today’s Hot Picks", callback_data='picks'))
         markup.add(telebot.types.InlineKeyboardButton("📰 Latest Sports Buzz", callback_data='news'))
         markup.add(telebot.types.InlineKeyboardButton("📅 My Subscription", callback_data='status'))
@@ -280,32 +451,37 @@ def get_user_menu(user_id):
         markup.add(telebot.types.InlineKeyboardButton("💎 Bi-Weekly Elite ($80)", callback_data='sub_biweekly'))
         markup.add(telebot.types.InlineKeyboardButton("🎁 Use Referral Code", callback_data='use_referral'))
         markup.add(telebot.types.InlineKeyboardButton("❓ Learn More", callback_data='help'))
-    return markup
+    return markup.to_json()
 
+@functools.lru_cache(maxsize=None)
 def get_admin_menu():
     markup = telebot.types.InlineKeyboardMarkup()
     markup.add(telebot.types.InlineKeyboardButton("📤 Send Picks", callback_data='admin_sendpicks'))
     markup.add(telebot.types.InlineKeyboardButton("👥 View Subscribers", callback_data='admin_viewsubs'))
     markup.add(telebot.types.InlineKeyboardButton("🗑️ Remove Subscriber", callback_data='admin_removesub'))
     markup.add(telebot.types.InlineKeyboardButton("✅ Manually Activate", callback_data='admin_activate'))
-    return markup
+    markup.row(telebot.types.InlineKeyboardButton("📥 Bulk Activate (CSV)", callback_data='admin_bulk_activate'),
+               telebot.types.InlineKeyboardButton("📥 Bulk Remove (CSV)", callback_data='admin_bulk_remove'))
+    markup.add(telebot.types.InlineKeyboardButton("📄 Export Users (CSV)", callback_data='admin_export'))
+    markup.add(telebot.types.InlineKeyboardButton("📊 Stats", callback_data='admin_stats'))
+    return markup.to_json()
 
+@functools.lru_cache(maxsize=None)
 def get_back_button(is_admin=False):
     markup = telebot.types.InlineKeyboardMarkup()
     callback = 'admin_back_to_main' if is_admin else 'back_to_main'
     markup.add(telebot.types.InlineKeyboardButton("🔙 Back to Menu", callback_data=callback))
-    return markup
+    return markup.to_json()
 
 # Bot handlers
-@bot.message_handler(commands=['start'])
 def send_welcome(message):
-    clean_expired_subscriptions()
     user_id = message.from_user.id
+    profile_cache.remember(message.from_user)
 
     if user_id == TEST_USER_ID:
         set_test_user_subscription(user_id)
 
-    if user_id == ADMIN_ID:
+    if user_id == config.admin_id:
         markup = get_admin_menu()
         bot.reply_to(message, "👑 Welcome, Admin! Manage your empire:", reply_markup=markup)
     else:
@@ -314,48 +490,82 @@ def send_welcome(message):
                         "Unlock expert picks for ALL sports - NBA, NFL, MLB, NHL, Tennis & more! 🏀🏈⚾\n"
                         "Join the VIP club and win BIG! 💰 Get these boys 🫡")
         bot.reply_to(message, welcome_text, reply_markup=markup)
-    logger.info(f"User {user_id} started bot")
+    logger.debug(f"User {user_id} started bot")
 
-@bot.callback_query_handler(func=lambda call: True)
 def handle_callback(call):
-    user_id = call.from_user.id
-    data = call.data
-    is_admin = user_id == ADMIN_ID
-    back_button = get_back_button(is_admin)
-
-    # User commands
-    if data == 'sub_weekly':
-        send_payment_link(user_id, "week")
-    elif data == 'sub_biweekly':
-        send_payment_link(user_id, "bi-weekly")
-    elif data == 'picks':
-        if not is_subscribed(user_id):
-            bot.answer_callback_query(call.id, "🔒 Subscribe to unlock premium picks!")
-            return
-        bot.send_message(user_id, "🏟️ Choose your sport for today’s hottest picks:", reply_markup=get_sports_menu())
-    elif data.startswith('sport_'):
-        if not is_subscribed(user_id):
-            bot.answer_callback_query(call.id, "🔒 Subscribe to unlock premium picks!")
-            return
-        sport = data.split('_')[1]
-        picks = SPORTS_PICKS.get(sport, ["Picks not available for this sport yet!"])
-        formatted_picks = format_picks(
-            SPORTS_PICKS['nba'],
-            SPORTS_PICKS['nfl'],
-            SPORTS_PICKS['mlb'],
-            SPORTS_PICKS['parlay']
-        )
-        bot.send_message(user_id, formatted_picks, reply_markup=back_button)
-        logger.info(f"{sport.upper()} picks sent to user {user_id}")
-    elif data == 'back_to_main':
-        bot.send_message(user_id, "🏆 Back to main menu:", reply_markup=get_user_menu(user_id))
-    elif data == 'admin_back_to_main':
-        bot.send_message(user_id, "👑 Back to admin menu:", reply_markup=get_admin_menu())
-    elif data == 'news':
-        if not is_subscribed(user_id):
-            bot.answer_callback_query(call.id, "🔒 Subscribe to get the latest news!")
+    """Throttle per user and coalesce repeated taps of the same button before dispatching."""
+    key = (call.from_user.id, call.data)
+    if not callback_limiter.allow(call.from_user.id):
+        CALLBACKS_REJECTED.inc(reason='throttled')
+        bot.answer_callback_query(call.id, "⏳ Slow down a little!")
+        return
+    if not callback_deduper.begin(key):
+        CALLBACKS_REJECTED.inc(reason='duplicate')
+        bot.answer_callback_query(call.id)
+        return
+    try:
+        dispatch_callback(call)
+    finally:
+        callback_deduper.end(key)
+
+def dispatch_callback(call):
+    ctx = CallbackContext(call, config.admin_id, is_subscribed)
+    start = time.perf_counter()
+    try:
+        if not callbacks.dispatch(ctx) and not ctx.is_admin:
+            bot.answer_callback_query(call.id, "🚫 Unauthorized action!")
+    except Exception:
+        CALLBACK_ERRORS.inc(route=ctx.route or 'unmatched')
+        raise
+    finally:
+        CALLBACK_SECONDS.observe(time.perf_counter() - start, route=ctx.route or 'unmatched')
+
+# Callback route middleware
+def subscribers_only(denied_text):
+    def middleware(ctx, handler):
+        if not ctx.subscribed:
+            bot.answer_callback_query(ctx.call.id, denied_text)
             return
-        news = """
+        handler(ctx)
+    return middleware
+
+def admin_only(ctx, handler):
+    if not ctx.is_admin:
+        bot.answer_callback_query(ctx.call.id, "🚫 Unauthorized action!")
+        return
+    handler(ctx)
+
+# User callbacks
+@callbacks.route('sub_weekly')
+def on_sub_weekly(ctx):
+    send_payment_link(ctx.user_id, "week", ctx.subscribed)
+
+@callbacks.route('sub_biweekly')
+def on_sub_biweekly(ctx):
+    send_payment_link(ctx.user_id, "bi-weekly", ctx.subscribed)
+
+@callbacks.route('picks', middleware=[subscribers_only("🔒 Subscribe to unlock premium picks!")])
+def on_picks(ctx):
+    bot.send_message(ctx.user_id, "🏟️ Choose your sport for today’s hottest picks:", reply_markup=get_sports_menu())
+
+@callbacks.route(prefix='sport_', middleware=[subscribers_only("🔒 Subscribe to unlock premium picks!")])
+def on_sport(ctx):
+    back_button = get_back_button(ctx.is_admin)
+    sport = ctx.data.split('_', 1)[1]
+    sport_picks = picks_store.get(sport) if sport in SPORT_TITLES else None
+    if sport_picks is None:
+        bot.send_message(ctx.user_id, "Picks not available for this sport yet!", reply_markup=back_button)
+        return
+    bot.send_message(ctx.user_id, render_picks(sport_picks, picks_store.get('parlay')), reply_markup=back_button)
+    logger.debug(f"{sport.upper()} picks sent to user {ctx.user_id}")
+
+@callbacks.route('back_to_main')
+def on_back_to_main(ctx):
+    bot.send_message(ctx.user_id, "🏆 Back to main menu:", reply_markup=build_user_menu(ctx.subscribed))
+
+@callbacks.route('news', middleware=[subscribers_only("🔒 Subscribe to get the latest news!")])
+def on_news(ctx):
+    news = """
         📰 Hot Sports Updates 📰
         1. NBA Finals set for June! 🏀
         2. NFL Draft rumors buzzing! 🏈
@@ -364,28 +574,36 @@ def handle_callback(call):
         5. Wimbledon dates confirmed! 🎾
         Stay ahead of the game! 🏆
         """
-        bot.send_message(user_id, news, reply_markup=back_button)
-        logger.info(f"News sent to user {user_id}")
-    elif data == 'status':
-        sub_info = get_user_subscription(user_id)
-        if sub_info and sub_info[1] == 'active':
-            end_date = sub_info[0]
-            bot.send_message(user_id, f"📅 Your VIP Status:\nActive until {end_date}\nKeep dominating the bets! 🏆", reply_markup=back_button)
-        else:
-            bot.send_message(user_id, "😔 No active subscription. Join the VIP club now!", reply_markup=get_user_menu(user_id))
-        logger.info(f"User {user_id} checked subscription status")
-    elif data == 'referral':
-        if not is_subscribed(user_id):
-            bot.answer_callback_query(call.id, "🔒 Subscribe to get your referral code!")
-            return
-        code = generate_referral_code(user_id) or "Error generating code"
-        bot.send_message(user_id, f"🎁 Your Referral Code: **{code}**\nShare with friends to earn bonuses!", reply_markup=back_button)
-        logger.info(f"Referral code generated for user {user_id}")
-    elif data == 'use_referral':
-        bot.send_message(user_id, "🏆 Enter a referral code to use:", reply_markup=back_button)
-        bot.register_next_step_handler(call.message, apply_referral_code)
-    elif data == 'help':
-        help_text = """
+    bot.send_message(ctx.user_id, news, reply_markup=get_back_button(ctx.is_admin))
+    logger.debug(f"News sent to user {ctx.user_id}")
+
+@callbacks.route('status')
+def on_status(ctx):
+    sub_info = get_user_subscription(ctx.user_id)
+    if sub_info and sub_info[1] == 'active':
+        end_date = format_timestamp(sub_info[0])
+        bot.send_message(ctx.user_id, f"📅 Your VIP Status:\nActive until {end_date}\nKeep dominating the bets! 🏆",
+                         reply_markup=get_back_button(ctx.is_admin))
+    else:
+        bot.send_message(ctx.user_id, "😔 No active subscription. Join the VIP club now!",
+                         reply_markup=build_user_menu(ctx.subscribed))
+    logger.debug(f"User {ctx.user_id} checked subscription status")
+
+@callbacks.route('referral', middleware=[subscribers_only("🔒 Subscribe to get your referral code!")])
+def on_referral(ctx):
+    code = generate_referral_code(ctx.user_id) or "Error generating code"
+    bot.send_message(ctx.user_id, f"🎁 Your Referral Code: **{code}**\nShare with friends to earn bonuses!",
+                     reply_markup=get_back_button(ctx.is_admin))
+    logger.debug(f"Referral code generated for user {ctx.user_id}")
+
+@callbacks.route('use_referral')
+def on_use_referral(ctx):
+    bot.send_message(ctx.user_id, "🏆 Enter a referral code to use:", reply_markup=get_back_button(ctx.is_admin))
+    bot.register_next_step_handler(ctx.call.message, apply_referral_code)
+
+@callbacks.route('help')
+def on_help(ctx):
+    help_text = """
         🏆 Sports Picks Heaven 🏆
         - Expert picks for ALL sports! 🏀🏈⚾🏒🎾
         - Weekly ($50) or Bi-Weekly ($80) VIP plans
@@ -393,35 +611,125 @@ def handle_callback(call):
         - Questions? Contact +12023205120
         Let’s win BIG together! 🚀
         """
-        bot.send_message(user_id, help_text, reply_markup=back_button)
-
-    # Admin commands
-    elif user_id == ADMIN_ID:
-        if data == 'admin_sendpicks':
-            bot.send_message(user_id, "📤 Type your picks below (any format, as many lines as you want):\n"
-                                     "Example:\n"
-                                     "NBA: Lakers +5.5 (-110)\n"
-                                     "NFL: Chiefs -3 (-105)\n"
-                                     "Parlay: Lakers ML + Chiefs -3 (+250)", reply_markup=back_button)
-            bot.register_next_step_handler(call.message, broadcast_picks)
-        elif data == 'admin_viewsubs':
-            subscribers = get_subscriber_details()
-            if not subscribers:
-                bot.send_message(user_id, "👥 No subscribers found.", reply_markup=back_button)
-                return
-            response = "👥 Subscriber Details:\n"
-            for sub_id, name, username, sub_end, status in subscribers:
-                response += f"ID: {sub_id}, Name: {name}, Username: {username}, End: {sub_end}, Status: {status}\n"
-            bot.send_message(user_id, response, reply_markup=back_button)
-            logger.info("Admin viewed subscribers")
-        elif data == 'admin_removesub':
-            bot.send_message(user_id, "🗑️ Enter the user ID to remove:", reply_markup=back_button)
-            bot.register_next_step_handler(call.message, remove_subscriber)
-        elif data == 'admin_activate':
-            bot.send_message(user_id, "✅ Enter the user ID and days to activate (e.g., '123456789 7' for 7 days):", reply_markup=back_button)
-            bot.register_next_step_handler(call.message, manually_activate_subscription)
+    bot.send_message(ctx.user_id, help_text, reply_markup=get_back_button(ctx.is_admin))
+
+# Admin callbacks
+@callbacks.route('admin_back_to_main')
+def on_admin_back_to_main(ctx):
+    bot.send_message(ctx.user_id, "👑 Back to admin menu:", reply_markup=get_admin_menu())
+
+@callbacks.route('admin_sendpicks', middleware=[admin_only])
+def on_admin_sendpicks(ctx):
+    bot.send_message(ctx.user_id, "📤 Type your picks below (any format, as many lines as you want).\n"
+                                  "Lines starting with NBA:, NFL:, MLB:, NHL:, Tennis: or Parlay: also update "
+                                  "the picks shown in the sport menus.\n"
+                                  "Example:\n"
+                                  "NBA: Lakers +5.5 (-110)\n"
+                                  "NFL: Chiefs -3 (-105)\n"
+                                  "Parlay: Lakers ML + Chiefs -3 (+250)", reply_markup=get_back_button(is_admin=True))
+    bot.register_next_step_handler(ctx.call.message, broadcast_picks)
+
+@callbacks.route('admin_viewsubs', prefix='admin_subs_', middleware=[admin_only])
+def on_admin_viewsubs(ctx):
+    send_subscriber_page(ctx.call)
+
+@callbacks.route('admin_removesub', middleware=[admin_only])
+def on_admin_removesub(ctx):
+    bot.send_message(ctx.user_id, "🗑️ Enter the user ID to remove:", reply_markup=get_back_button(is_admin=True))
+    bot.register_next_step_handler(ctx.call.message, remove_subscriber)
+
+@callbacks.route('admin_activate', middleware=[admin_only])
+def on_admin_activate(ctx):
+    bot.send_message(ctx.user_id, "✅ Enter the user ID and days to activate (e.g., '123456789 7' for 7 days):",
+                     reply_markup=get_back_button(is_admin=True))
+    bot.register_next_step_handler(ctx.call.message, manually_activate_subscription)
+
+@callbacks.route('admin_bulk_activate', middleware=[admin_only])
+def on_admin_bulk_activate(ctx):
+    bot.send_message(ctx.user_id, "📥 Upload a CSV file with one 'user_id,days' row per user to activate:",
+                     reply_markup=get_back_button(is_admin=True))
+    bot.register_next_step_handler(ctx.call.message, bulk_import, 'activate')
+
+@callbacks.route('admin_bulk_remove', middleware=[admin_only])
+def on_admin_bulk_remove(ctx):
+    bot.send_message(ctx.user_id, "📥 Upload a CSV file with one user ID per row to remove:",
+                     reply_markup=get_back_button(is_admin=True))
+    bot.register_next_step_handler(ctx.call.message, bulk_import, 'remove')
+
+@callbacks.route('admin_export', middleware=[admin_only])
+def on_admin_export(ctx):
+    bot.answer_callback_query(ctx.call.id, "📄 Preparing export...")
+    threading.Thread(target=export_users_csv, args=(ctx.user_id,), name='users-export', daemon=True).start()
+
+def stat_total(totals, kind, plan=None):
+    """(events, amount_cents) of one kind in a summary window, for one plan or all of them."""
+    rows = [value for (k, p), value in totals.items() if k == kind and (plan is None or p == plan)]
+    return sum(row[0] for row in rows), sum(row[1] for row in rows)
+
+def format_stats(summary):
+    """Admin stats message from Analytics.summary()."""
+    snapshot = summary['snapshot']
+    if snapshot:
+        active, pending, taken_at = snapshot
+        text = f"📊 Stats (as of {format_timestamp(taken_at, '%Y-%m-%d %H:%M')})\n"
+        text += f"Active subscribers: {active}\nPending checkouts: {pending}\n"
+    else:
+        text = "📊 Stats (not rolled up yet)\n"
+    for label, totals in summary['windows']:
+        payments, revenue = stat_total(totals, 'payment')
+        checkouts = stat_total(totals, 'checkout')[0]
+        text += f"\n{label}:\n"
+        text += f"💰 Revenue: ${revenue / 100:.2f} from {payments} payments\n"
+        for plan in ('week', 'bi-weekly'):
+            count, cents = stat_total(totals, 'payment', plan)
+            text += f"   {plan}: {count} (${cents / 100:.2f})\n"
+        if checkouts:
+            text += f"🛒 Checkouts: {checkouts} ({payments / checkouts:.0%} paid)\n"
+        else:
+            text += "🛒 Checkouts: 0\n"
+        text += f"✅ Manual activations: {stat_total(totals, 'manual')[0]}, "
+        text += f"referral bonuses: {stat_total(totals, 'referral_bonus')[0]}\n"
+        text += f"📉 Expired: {stat_total(totals, 'expired')[0]}, removed: {stat_total(totals, 'removed')[0]}\n"
+    return text
+
+@callbacks.route('admin_stats', middleware=[admin_only])
+def on_admin_stats(ctx):
+    try:
+        text = format_stats(analytics.summary())
+    except Exception as e:
+        logger.error(f"Error reading stats: {e}")
+        text = "❌ Couldn't load stats right now."
+    bot.send_message(ctx.user_id, text, reply_markup=get_back_button(is_admin=True))
+
+def send_subscriber_page(call):
+    """Show a page of subscribers; 'admin_subs_next:<id>'/'admin_subs_prev:<id>' edit the message in place."""
+    data = call.data
+    after_id = int(data.split(':')[1]) if data.startswith('admin_subs_next:') else None
+    before_id = int(data.split(':')[1]) if data.startswith('admin_subs_prev:') else None
+    subscribers, has_prev, has_next = get_subscriber_page(after_id=after_id, before_id=before_id)
+    if not subscribers:
+        bot.send_message(call.from_user.id, "👥 No subscribers found.", reply_markup=get_back_button(is_admin=True))
+        return
+
+    response = "👥 Subscriber Details:\n"
+    for sub_id, name, username, sub_end, status in subscribers:
+        response += f"ID: {sub_id}, Name: {name}, Username: {username}, End: {sub_end}, Status: {status}\n"
+
+    markup = telebot.types.InlineKeyboardMarkup()
+    nav = []
+    if has_prev:
+        nav.append(telebot.types.InlineKeyboardButton("⬅️ Prev", callback_data=f"admin_subs_prev:{subscribers[0][0]}"))
+    if has_next:
+        nav.append(telebot.types.InlineKeyboardButton("Next ➡️", callback_data=f"admin_subs_next:{subscribers[-1][0]}"))
+    if nav:
+        markup.row(*nav)
+    markup.add(telebot.types.InlineKeyboardButton("🔙 Back to Menu", callback_data='admin_back_to_main'))
+
+    if data == 'admin_viewsubs':
+        bot.send_message(call.from_user.id, response, reply_markup=markup)
     else:
-        bot.answer_callback_query(call.id, "🚫 Unauthorized action!")
+        bot.edit_message_text(response, call.message.chat.id, call.message.message_id, reply_markup=markup)
+    logger.info("Admin viewed subscribers")
 
 def apply_referral_code(message):
     user_id = message.from_user.id
@@ -433,7 +741,7 @@ def apply_referral_code(message):
         bot.send_message(user_id, "❌ Invalid or unavailable referral code. Try again!", reply_markup=back_button)
 
 def broadcast_picks(message):
-    if message.from_user.id != ADMIN_ID:
+    if message.from_user.id != config.admin_id:
         return
     back_button = get_back_button(is_admin=True)
     
@@ -442,6 +750,16 @@ def broadcast_picks(message):
         bot.send_message(message.chat.id, "❌ Please enter at least one pick!", reply_markup=back_button)
         return
 
+    published = []
+    for sport, lines in parse_picks_input(picks_input).items():
+        try:
+            picks_store.publish(sport, lines, published_by=message.from_user.id)
+            published.append(sport.upper())
+        except Exception as e:
+            logger.error(f"Error publishing {sport} picks: {e}")
+    if published:
+        bot.send_message(message.chat.id, f"🗂️ Published picks for: {', '.join(published)}")
+
     current_date = datetime.now().strftime('%Y-%m-%d')
     formatted_picks = f"📢 Sports Picks – {current_date}\n\n{picks_input}\n\n"
     formatted_picks += "🔔 Risk Management Tip: Always bet responsibly and manage your bankroll wisely.\n"
@@ -453,27 +771,23 @@ def broadcast_picks(message):
         bot.send_message(message.chat.id, "❌ No active subscribers found!", reply_markup=back_button)
         return
 
-    successful_sends = 0
-    for sub_id in subscribers:
-        try:
-            bot.send_message(sub_id, formatted_picks)
-            successful_sends += 1
-        except Exception as e:
-            logger.error(f"Failed to send picks to {sub_id}: {e}")
-
-    bot.send_message(message.chat.id, f"📤 Picks sent to {successful_sends} out of {len(subscribers)} active subscribers!", reply_markup=back_button)
-    logger.info(f"Admin sent picks to {successful_sends} out of {len(subscribers)} active subscribers")
+    status_message = bot.send_message(message.chat.id, f"📤 Queued picks for {len(subscribers)} active subscribers...",
+                                      reply_markup=back_button)
+    broadcast_queue.enqueue(formatted_picks, subscribers, admin_chat_id=message.chat.id,
+                            status_message_id=status_message.message_id)
+    logger.info(f"Admin queued picks for {len(subscribers)} active subscribers")
 
 def remove_subscriber(message):
-    if message.from_user.id != ADMIN_ID:
+    if message.from_user.id != config.admin_id:
         return
     back_button = get_back_button(is_admin=True)
     try:
         user_id = int(message.text)
-        with sqlite3.connect('users.db') as conn:
-            c = conn.cursor()
-            c.execute("DELETE FROM users WHERE user_id=?", (user_id,))
-            conn.commit()
+        with db.transaction():
+            if db.execute("DELETE FROM users WHERE user_id=?", (user_id,)):
+                analytics.record('removed', user_id)
+        subscription_cache.invalidate(user_id)
+        forget_checkouts(user_id)
         bot.send_message(message.chat.id, f"🗑️ User {user_id} removed from subscribers!", reply_markup=back_button)
         logger.info(f"Admin removed user {user_id}")
     except ValueError:
@@ -483,7 +797,7 @@ def remove_subscriber(message):
         logger.error(f"Error removing subscriber: {e}")
 
 def manually_activate_subscription(message):
-    if message.from_user.id != ADMIN_ID:
+    if message.from_user.id != config.admin_id:
         return
     back_button = get_back_button(is_admin=True)
     try:
@@ -504,53 +818,185 @@ def manually_activate_subscription(message):
         bot.send_message(message.chat.id, f"Error activating subscription: {e}", reply_markup=back_button)
         logger.error(f"Error in manual activation: {e}")
 
-# Webhook endpoint
-@app.route('/webhook', methods=['POST'])
-def webhook():
-    payload = request.data
-    sig_header = request.headers.get('Stripe-Signature')
+def bulk_import(message, action):
+    """Apply an uploaded CSV of activations ('user_id,days') or removals ('user_id') in one transaction."""
+    if message.from_user.id != config.admin_id:
+        return
+    back_button = get_back_button(is_admin=True)
+    if message.content_type != 'document':
+        bot.send_message(message.chat.id, "❌ Please upload the list as a .csv file.", reply_markup=back_button)
+        return
+    try:
+        file_info = bot.get_file(message.document.file_id)
+        text = bot.download_file(file_info.file_path).decode('utf-8-sig')
+        if action == 'activate':
+            activations = bulk.parse_activations(text)
+            with db.transaction():
+                ends = bulk.activate_many(db, activations)
+                by_days = {}
+                for user_id, days in activations.items():
+                    by_days.setdefault(days, []).append(user_id)
+                for days, user_ids in by_days.items():
+                    analytics.record('manual', user_ids, days=days)
+            subscription_cache.invalidate_many(list(ends))
+            notify_activations(ends)
+            bot.send_message(message.chat.id, f"✅ Activated {len(ends)} subscriptions. Notifying the users...",
+                             reply_markup=back_button)
+            logger.info(f"Admin bulk-activated {len(ends)} subscriptions")
+        else:
+            with db.transaction():
+                removed = bulk.remove_many(db, bulk.parse_removals(text))
+                analytics.record('removed', removed)
+            subscription_cache.invalidate_many(removed)
+            for user_id in removed:
+                forget_checkouts(user_id)
+            bot.send_message(message.chat.id, f"🗑️ Removed {len(removed)} users.", reply_markup=back_button)
+            logger.info(f"Admin bulk-removed {len(removed)} users")
+    except bulk.BulkImportError as e:
+        bot.send_message(message.chat.id, f"❌ Nothing was changed, the file has problems:\n{e}", reply_markup=back_button)
+    except UnicodeDecodeError:
+        bot.send_message(message.chat.id, "❌ The file must be UTF-8 text.", reply_markup=back_button)
+    except Exception as e:
+        bot.send_message(message.chat.id, f"Error applying bulk {action}: {e}", reply_markup=back_button)
+        logger.error(f"Error in bulk {action}: {e}")
+
+def notify_activations(ends):
+    """Queue activation notices through the throttled broadcast queue, one job per end date."""
+    by_date = {}
+    for user_id, end in ends.items():
+        by_date.setdefault(format_timestamp(end, '%Y-%m-%d'), []).append(user_id)
+    for end_date, user_ids in by_date.items():
+        broadcast_queue.enqueue(f"🏆 Your subscription has been activated! It’s active until {end_date}! 🚀", user_ids)
+
+def export_users_csv(chat_id):
+    """Write the users table to a temporary CSV page by page and send it as a document."""
     try:
-        event = stripe.Webhook.construct_event(payload, sig_header, WEBHOOK_SECRET)
-    except (ValueError, stripe.error.SignatureVerificationError) as e:
-        logger.error(f"Webhook verification failed: {e}")
-        return 'Invalid request', 400
-
-    if event['type'] == 'checkout.session.completed':
-        session = event['data']['object']
-        user_id = session.get('metadata', {}).get('user_id')
-        days = int(session.get('metadata', {}).get('days', 7))  # Default to 7 if missing
-        if not user_id:
-            logger.error("No user_id in metadata")
-            return 'No user_id', 400
+        with tempfile.NamedTemporaryFile('w+', suffix='.csv', newline='', encoding='utf-8') as out:
+            count = bulk.export_users(db, out)
+            out.flush()
+            with open(out.name, 'rb') as document:
+                bot.send_document(chat_id, document, caption=f"📄 {count} users",
+                                  visible_file_name=f"users-{datetime.now().strftime('%Y%m%d-%H%M')}.csv")
+        logger.info(f"Admin exported {count} users")
+    except Exception as e:
+        bot.send_message(chat_id, f"Error exporting users: {e}")
+        logger.error(f"Error exporting users: {e}")
+
+# Stripe event handlers, run by the stripe_events consumer thread
+def apply_checkout_completed(event):
+    session = event['data']['object']
+    user_id = int(session['metadata']['user_id'])
+    days = int(session['metadata'].get('days', 7))  # Default to 7 if missing
+    subscription_cache.invalidate(user_id)
+    forget_checkouts(user_id)
+    result = db.fetchone('pending_checkout', (user_id,))
+    if result:
+        payment_link, pending_plan = result[0], result[1]
+        # Errors propagate: the event goes back to 'queued' and is retried instead of being marked processed
+        with db.transaction():
+            end_date = activate_subscription(user_id, days, payment_link, kind='payment',
+                                             plan=session['metadata'].get('plan') or pending_plan,
+                                             amount_cents=session.get('amount_total') or 0, ref=session.get('id'))
+            referrals.record_conversion(user_id)
+        subscription_cache.invalidate(user_id)
+        send_activation_notice(user_id, end_date)
+        logger.info(f"Webhook updated subscription for user {user_id} with {days} days")
+    else:
+        logger.error(f"User {user_id} not found or not pending")
+
+# Process lifecycle
+def start_background(*services):
+    for service in services:
+        background_services.append(service)
+        background_threads.append(service.start(shutdown_event))
 
+def leader_only(name, service):
+    """Run `service` in just one of the bot/worker processes sharing the database, failing over between them."""
+    return LeaderOnly(db, name, service)
+
+def shutdown(*_):
+    """Stop polling and background services, letting in-flight work finish. Safe to call more than once."""
+    if shutdown_event.is_set() or config is None:
+        return
+    logger.info("Shutting down...")
+    shutdown_event.set()
+    for service in background_services:
+        service.wakeup.set()
+    bot.stop_polling()
+    for thread in background_threads:
+        thread.join(timeout=SHUTDOWN_TIMEOUT)
+    update_dispatcher.shutdown()
+    stripe_executor.shutdown(wait=True)
+    broadcaster.executor.shutdown(wait=True)
+    logger.info("Shutdown complete")
+    stop_logging()
+
+def run_transport():
+    """Receive Telegram updates until shutdown: via the /telegram webhook route, or by long polling."""
+    if config.telegram_transport == 'webhook':
         try:
-            with sqlite3.connect('users.db') as conn:
-                c = conn.cursor()
-                c.execute("SELECT payment_link FROM users WHERE user_id=? AND payment_status='pending'", (int(user_id),))
-                result = c.fetchone()
-                if result:
-                    payment_link = result[0]
-                    update_subscription(int(user_id), days, payment_link)
-                    logger.info(f"Webhook updated subscription for user {user_id} with {days} days")
-                else:
-                    logger.error(f"User {user_id} not found or not pending")
+            bot.set_webhook(url=f"{config.domain}/telegram", secret_token=config.telegram_webhook_secret,
+                            max_connections=config.update_workers)
+            logger.info(f"Telegram webhook set to {config.domain}/telegram")
+            shutdown_event.wait()
+            return
         except Exception as e:
-            logger.error(f"Webhook processing error for user {user_id}: {e}")
-    return 'Success', 200
+            logger.error(f"Failed to set Telegram webhook, falling back to polling: {e}")
+    try:
+        bot.remove_webhook()
+    except Exception as e:
+        logger.error(f"Failed to remove Telegram webhook: {e}")
+    if not bot.threaded:
+        # A webhook-mode client runs handlers inline, so hand polled updates to update_dispatcher's pool
+        poll_updates(bot, update_dispatcher, shutdown_event)
+        return
+    # infinity_polling restarts after errors such as read timeouts instead of letting the process exit
+    bot.infinity_polling(timeout=20, long_polling_timeout=20)
 
 # Run bot and webhook server
-if __name__ == "__main__":
+# PROCESS_TYPE selects what this process runs:
+#   web    - served by gunicorn via wsgi.py (web.create_app), not through this function
+#   bot    - Telegram transport (sets the webhook or polls) plus the expiry sweeper, broadcast drainer
+#            and referral rewards job
+#   worker - broadcast drainer only; never imports Flask or stripe
+#   unset  - everything in one process with Flask's development server (local testing)
+def main():
+    process_type = os.getenv('PROCESS_TYPE')
+    setup()
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
     init_db()
-    clean_expired_subscriptions()
-    logger.info("Starting bot and webhook server...")
-
-    def run_flask():
-        app.run(host='0.0.0.0', port=4242)
+    if process_type in ('bot', 'worker') and os.getenv('METRICS_PORT'):
+        import web
+        web.serve_metrics(int(os.getenv('METRICS_PORT')))
+
+    if process_type == 'worker':
+        logger.info("Starting broadcast worker...")
+        start_background(leader_only('broadcast-queue', broadcast_queue))
+        shutdown_event.wait()
+    else:
+        if process_type == 'bot':
+            logger.info("Starting bot...")
+            start_background(picks_store)
+        else:
+            import web
+            logger.info("Starting bot and webhook server...")
+            app = web.create_app()  # also starts the picks reloader
+            flask_thread = threading.Thread(target=lambda: app.run(host='0.0.0.0', port=int(os.getenv('PORT', 4242))),
+                                            daemon=True)
+            flask_thread.start()
+        start_background(leader_only('broadcast-queue', broadcast_queue),
+                         leader_only('expiry-sweeper', expiry_sweeper),
+                         leader_only('profile-refresh', profile_cache),
+                         leader_only('referral-rewards', referrals),
+                         leader_only('stats-rollup', analytics))
 
-    flask_thread = threading.Thread(target=run_flask)
-    flask_thread.start()
+        try:
+            run_transport()
+        except Exception as e:
+            logger.error(f"Bot transport error: {e}")
+        shutdown()
 
-    try:
-        bot.polling(none_stop=True)
-    except Exception as e:
-        logger.error(f"Bot polling error: {e}")
+if __name__ == "__main__":
+    sys.modules['bot'] = sys.modules[__name__]  # web.py imports bot; give it this module rather than a second copy
+    main()
@@ -0,0 +1,289 @@
+import logging
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from telebot.apihelper import ApiTelegramException
+
+from jobs import BackgroundJob
+
+logger = logging.getLogger(__name__)
+
+# Telegram allows roughly 30 messages/second across all chats and 1 message/second to a single chat
+GLOBAL_RATE = 30
+PER_CHAT_RATE = 1
+MAX_WORKERS = 16
+MAX_RETRIES = 3
+BATCH_SIZE = 100  # recipients claimed per drain iteration
+POLL_INTERVAL = 5  # seconds the worker idles when the queue is empty
+CLAIM_TIMEOUT = 600  # seconds before an unfinished 'sending' row is considered interrupted
+
+
+class TokenBucket:
+    """Thread-safe token bucket; acquire() blocks until a token is available."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def pause(self, seconds):
+        """Stop handing out tokens for `seconds` (after a 429); refilling restarts when the pause ends."""
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0.0
+            self.updated = self.paused_until
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                else:
+                    self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class PerChatLimiter:
+    """Spaces out sends to the same chat so no chat exceeds `rate` messages/second."""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self.next_allowed = {}
+        self.lock = threading.Lock()
+
+    def acquire(self, chat_id):
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_allowed.get(chat_id, 0.0))
+            self.next_allowed[chat_id] = slot + self.interval
+            if len(self.next_allowed) > 10000:
+                self.next_allowed = {k: v for k, v in self.next_allowed.items() if v > now}
+        if slot > now:
+            time.sleep(slot - now)
+
+
+def retry_after(error):
+    """Seconds Telegram asked us to wait for a 429, or None for any other error."""
+    if isinstance(error, ApiTelegramException) and error.error_code == 429:
+        return (error.result_json.get('parameters') or {}).get('retry_after', 1)
+    return None
+
+
+class BroadcastResult:
+    def __init__(self, total):
+        self.total = total
+        self.sent = 0
+        self.failed = 0
+        self.lock = threading.Lock()
+
+    @property
+    def done(self):
+        return self.sent + self.failed
+
+
+class BroadcastEngine:
+    """Sends one message to many chats through a bounded worker pool.
+
+    All sends share a global token bucket and a per-chat limiter, so concurrent
+    broadcasts together stay under Telegram's limits. A 429 pauses the global
+    bucket for `retry_after` seconds and the send is retried.
+    """
+
+    def __init__(self, send_func, max_workers=MAX_WORKERS, global_rate=GLOBAL_RATE, per_chat_rate=PER_CHAT_RATE):
+        self.send_func = send_func
+        self.max_workers = max_workers
+        self.bucket = TokenBucket(global_rate)
+        self.chat_limiter = PerChatLimiter(per_chat_rate)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='broadcast')
+
+    def send_one(self, chat_id, text, **kwargs):
+        """Rate-limited send with 429 retries. Returns True on success, raises the last error otherwise."""
+        for attempt in range(MAX_RETRIES + 1):
+            self.chat_limiter.acquire(chat_id)
+            self.bucket.acquire()
+            try:
+                self.send_func(chat_id, text, **kwargs)
+                return True
+            except Exception as e:
+                wait = retry_after(e)
+                if wait is None or attempt == MAX_RETRIES:
+                    raise
+                logger.warning(f"Rate limited sending to {chat_id}, retrying in {wait}s")
+                self.bucket.pause(wait)
+
+    def broadcast(self, chat_ids, text, **kwargs):
+        """Send `text` to every chat in `chat_ids` and block until all sends finish.
+
+        Returns a BroadcastResult with success/failure counts.
+        """
+        chat_ids = list(chat_ids)
+        result = BroadcastResult(len(chat_ids))
+        in_flight = threading.Semaphore(self.max_workers * 2)
+        finished = threading.Event()
+
+        def task(chat_id):
+            try:
+                self.send_one(chat_id, text, **kwargs)
+                ok = True
+            except Exception as e:
+                logger.error(f"Failed to send broadcast to {chat_id}: {e}")
+                ok = False
+            finally:
+                in_flight.release()
+            with result.lock:
+                if ok:
+                    result.sent += 1
+                else:
+                    result.failed += 1
+                if result.done == result.total:
+                    finished.set()
+
+        if not chat_ids:
+            return result
+        for chat_id in chat_ids:
+            in_flight.acquire()
+            self.executor.submit(task, chat_id)
+        finished.wait()
+        return result
+
+
+class BroadcastQueue(BackgroundJob):
+    """Durable broadcast jobs stored in the users database.
+
+    Each job has one row per recipient in broadcast_recipients. Drainers claim
+    'queued' rows in batches (marking them 'sending'), send them through the
+    BroadcastEngine and record 'sent' or 'failed' as each send completes. Rows left
+    in 'sending' by a process that died mid-send are marked 'unknown' rather than re-sent, so a
+    restart never delivers the same picks twice.
+    """
+
+    thread_name = 'broadcast-worker'
+    title = 'Broadcast worker'
+
+    def __init__(self, db, engine, bot, batch_size=BATCH_SIZE, poll_interval=POLL_INTERVAL):
+        super().__init__()
+        self.db = db
+        self.engine = engine
+        self.bot = bot
+        self.batch_size = batch_size
+        self.interval = poll_interval
+        self.last_recovery = None
+
+    def enqueue(self, text, chat_ids, admin_chat_id=None, status_message_id=None):
+        """Persist a broadcast job and its recipients in one transaction and wake the drainer."""
+        chat_ids = list(dict.fromkeys(chat_ids))
+        with self.db.transaction():
+            job_id = self.db.fetchone("INSERT INTO broadcast_jobs (text, admin_chat_id, status_message_id, status, total, created_at) "
+                                      "VALUES (?, ?, ?, 'queued', ?, ?) RETURNING job_id",
+                                      (text, admin_chat_id, status_message_id, len(chat_ids), int(time.time())))[0]
+            self.db.executemany("INSERT INTO broadcast_recipients (job_id, user_id, state) VALUES (?, ?, 'queued')",
+                                [(job_id, chat_id) for chat_id in chat_ids])
+        self.wakeup.set()
+        logger.info(f"Broadcast job {job_id} queued for {len(chat_ids)} recipients")
+        return job_id
+
+    def recover_stale(self):
+        """Mark rows stuck in 'sending' past the claim timeout as 'unknown' so they are never re-sent."""
+        count = self.db.execute("UPDATE broadcast_recipients SET state='unknown', error='interrupted during send' "
+                                "WHERE state='sending' AND claimed_at < ?", (int(time.time()) - CLAIM_TIMEOUT,))
+        if count:
+            logger.warning(f"Marked {count} interrupted broadcast sends as unknown")
+        return count
+
+    def claim_batch(self):
+        token = uuid.uuid4().hex
+        with self.db.transaction():
+            self.db.execute("UPDATE broadcast_recipients SET state='sending', claim_token=?, claimed_at=? "
+                            "WHERE (job_id, user_id) IN (SELECT job_id, user_id FROM broadcast_recipients "
+                            "WHERE state='queued' ORDER BY job_id LIMIT ?)", (token, int(time.time()), self.batch_size))
+            rows = self.db.fetchall("SELECT r.job_id, r.user_id, j.text FROM broadcast_recipients r "
+                                    "JOIN broadcast_jobs j ON j.job_id = r.job_id WHERE r.claim_token=?", (token,))
+            self.db.execute("UPDATE broadcast_jobs SET status='sending' WHERE status='queued' AND job_id IN "
+                            "(SELECT job_id FROM broadcast_recipients WHERE claim_token=?)", (token,))
+        return rows
+
+    def send_batch(self, rows):
+        """Send a claimed batch on the engine's pool, recording each recipient as its send finishes,
+        so a crash mid-batch only leaves the sends actually in flight as 'sending'."""
+        wait([self.engine.executor.submit(self.deliver, job_id, user_id, text) for job_id, user_id, text in rows])
+        return list({job_id for job_id, _, _ in rows})
+
+    def deliver(self, job_id, user_id, text):
+        try:
+            self.engine.send_one(user_id, text)
+            state, error = 'sent', None
+        except Exception as e:
+            logger.error(f"Failed to send broadcast {job_id} to {user_id}: {e}")
+            state, error = 'failed', str(e)
+        try:
+            self.db.execute("UPDATE broadcast_recipients SET state=?, error=? WHERE job_id=? AND user_id=?",
+                            (state, error, job_id, user_id))
+        except Exception as e:
+            logger.error(f"Error recording broadcast {job_id} delivery to {user_id}: {e}")
+
+    def job_counts(self, job_id):
+        return dict(self.db.fetchall("SELECT state, COUNT(*) FROM broadcast_recipients WHERE job_id=? GROUP BY state",
+                                     (job_id,)))
+
+    def report(self, job_ids):
+        """Edit each job's progress message and send the final summary once a job has no pending rows."""
+        for job_id in job_ids:
+            job = self.db.fetchone("SELECT admin_chat_id, status_message_id, total, status FROM broadcast_jobs WHERE job_id=?",
+                                   (job_id,))
+            if not job:
+                continue
+            admin_chat_id, status_message_id, total, status = job
+            counts = self.job_counts(job_id)
+            sent, failed, unknown = counts.get('sent', 0), counts.get('failed', 0), counts.get('unknown', 0)
+            pending = counts.get('queued', 0) + counts.get('sending', 0)
+            try:
+                if pending:
+                    if admin_chat_id and status_message_id:
+                        self.bot.edit_message_text(
+                            f"📤 Sending picks... {total - pending}/{total} processed ({sent} sent, {failed} failed)",
+                            admin_chat_id, status_message_id)
+                    continue
+                finished_now = self.db.execute("UPDATE broadcast_jobs SET status='done', finished_at=? "
+                                               "WHERE job_id=? AND status!='done'", (int(time.time()), job_id)) == 1
+                if finished_now and admin_chat_id:
+                    summary = f"📤 Picks sent to {sent} out of {total} active subscribers! ({failed} failed"
+                    summary += f", {unknown} interrupted)" if unknown else ")"
+                    self.engine.send_one(admin_chat_id, summary)
+                    logger.info(f"Broadcast job {job_id} finished: {sent}/{total} sent, {failed} failed, {unknown} unknown")
+            except Exception as e:
+                logger.error(f"Error reporting progress for broadcast job {job_id}: {e}")
+
+    def finish_interrupted_jobs(self):
+        job_ids = [row[0] for row in self.db.fetchall("SELECT job_id FROM broadcast_jobs WHERE status!='done'")]
+        self.report(job_ids)
+
+    def drain_once(self):
+        """Claim and send one batch. Returns the number of recipients processed."""
+        rows = self.claim_batch()
+        if rows:
+            self.report(self.send_batch(rows))
+        return len(rows)
+
+    def run_once(self):
+        """Drain one batch, picking up any work left by a previous process; idles when there was none."""
+        if self.last_recovery is None or time.monotonic() - self.last_recovery > CLAIM_TIMEOUT / 2:
+            # On startup, also finish jobs whose last rows were recorded just before a crash
+            if self.recover_stale() or self.last_recovery is None:
+                self.finish_interrupted_jobs()
+            self.last_recovery = time.monotonic()
+        return 0 if self.drain_once() else None
+
+    def stopped(self):
+        # A later start (e.g. after winning the lease back) recovers again as on startup
+        self.last_recovery = None
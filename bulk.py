@@ -0,0 +1,103 @@
+import csv
+import io
+import time
+from datetime import datetime
+
+MAX_ROWS = 20000  # rows accepted per uploaded CSV
+MAX_ERRORS_SHOWN = 10
+EXPORT_BATCH = 1000  # users read per query while exporting
+EXPORT_COLUMNS = ['user_id', 'first_name', 'username', 'payment_status', 'subscription_end', 'referral_code']
+
+
+class BulkImportError(ValueError):
+    """The uploaded CSV can't be applied; `errors` lists the offending lines."""
+
+    def __init__(self, errors):
+        self.errors = errors
+        shown = '\n'.join(errors[:MAX_ERRORS_SHOWN])
+        more = f"\n... and {len(errors) - MAX_ERRORS_SHOWN} more" if len(errors) > MAX_ERRORS_SHOWN else ''
+        super().__init__(shown + more)
+
+
+def _rows(text):
+    """Non-empty CSV rows as (line number, cells), skipping a header row if there is one."""
+    rows = [(number, [cell.strip() for cell in row]) for number, row in enumerate(csv.reader(io.StringIO(text)), 1)
+            if any(cell.strip() for cell in row)]
+    if rows and not rows[0][1][0].lstrip('-').isdigit():
+        rows = rows[1:]
+    if len(rows) > MAX_ROWS:
+        raise BulkImportError([f"Too many rows ({len(rows)}); the limit is {MAX_ROWS}"])
+    return rows
+
+
+def parse_activations(text):
+    """'user_id,days' rows -> {user_id: days}. A user listed twice keeps the last row."""
+    activations, errors = {}, []
+    for number, cells in _rows(text):
+        try:
+            user_id, days = int(cells[0]), int(cells[1])
+            if days <= 0:
+                raise ValueError
+            activations[user_id] = days
+        except (ValueError, IndexError):
+            errors.append(f"Line {number}: expected 'user_id,days' with positive days, got {','.join(cells)!r}")
+    if errors:
+        raise BulkImportError(errors)
+    return activations
+
+
+def parse_removals(text):
+    """'user_id' rows (extra columns ignored) -> list of user ids."""
+    user_ids, errors = [], []
+    for number, cells in _rows(text):
+        try:
+            user_ids.append(int(cells[0]))
+        except ValueError:
+            errors.append(f"Line {number}: expected a user id, got {cells[0]!r}")
+    if errors:
+        raise BulkImportError(errors)
+    return list(dict.fromkeys(user_ids))
+
+
+def activate_many(db, activations, payment_link="Manually Activated"):
+    """Add each user's number of days in one transaction. Returns {user_id: end epoch}."""
+    now = int(time.time())
+    ends = {}
+    with db.transaction():
+        for user_id, days in activations.items():
+            ends[user_id] = db.fetchone('activate_subscription',
+                                        (user_id, now + days * 86400, payment_link, now, now, days * 86400))[0]
+    return ends
+
+
+def remove_many(db, user_ids):
+    """Delete the users in one transaction. Returns the ids that existed."""
+    with db.transaction():
+        existing = []
+        for start in range(0, len(user_ids), 500):
+            chunk = user_ids[start:start + 500]
+            rows = db.fetchall(f"SELECT user_id FROM users WHERE user_id IN ({', '.join('?' * len(chunk))})", chunk)
+            existing.extend(row[0] for row in rows)
+        db.executemany("DELETE FROM users WHERE user_id=?", [(user_id,) for user_id in existing])
+    return existing
+
+
+def export_users(db, out, batch_size=EXPORT_BATCH):
+    """Write the users table as CSV to the text file `out`, one keyset page at a time. Returns the row count."""
+    writer = csv.writer(out)
+    writer.writerow(EXPORT_COLUMNS)
+    count, last_id = 0, None
+    while True:
+        rows = db.fetchall("SELECT u.user_id, p.first_name, p.username, u.payment_status, u.subscription_end, r.code "
+                           "FROM users u LEFT JOIN profiles p ON p.user_id = u.user_id "
+                           "LEFT JOIN referral_codes r ON r.user_id = u.user_id "
+                           + ("WHERE u.user_id > ? " if last_id is not None else "")
+                           + "ORDER BY u.user_id LIMIT ?",
+                           ((last_id,) if last_id is not None else ()) + (batch_size,))
+        for user_id, first_name, username, status, end, code in rows:
+            end = datetime.fromtimestamp(end).strftime('%Y-%m-%d %H:%M:%S') if end else ''
+            writer.writerow([user_id, first_name or '', username or '', status or '', end, code or ''])
+        count += len(rows)
+        if len(rows) < batch_size:
+            return count
+        last_id = rows[-1][0]
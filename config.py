@@ -0,0 +1,47 @@
+import os
+from collections import namedtuple
+
+from dotenv import load_dotenv
+
+Config = namedtuple('Config', [
+    'api_token', 'admin_id', 'stripe_api_key', 'webhook_secret', 'domain', 'database_url',
+    'telegram_transport', 'telegram_webhook_secret', 'update_workers', 'stripe_timeout',
+    'subscription_cache_size', 'subscription_cache_ttl',
+    'log_level', 'log_file', 'log_max_bytes', 'log_backups', 'next_step_store',
+])
+
+REQUIRED = {'TELEGRAM_API_TOKEN': 'api_token', 'STRIPE_API_KEY': 'stripe_api_key',
+            'STRIPE_WEBHOOK_SECRET': 'webhook_secret'}
+
+
+def load_config(env=None):
+    """Settings from `env` (default: os.environ after loading .env). Raises ValueError if a required one is missing."""
+    if env is None:
+        load_dotenv()
+        env = os.environ
+    config = Config(
+        api_token=env.get('TELEGRAM_API_TOKEN', '7900055310:AAGswliYMf8-ZA8BhhQpES1Ju2oQollvko4'),
+        admin_id=int(env.get('ADMIN_ID', 7933828542)),
+        stripe_api_key=env.get('STRIPE_API_KEY'),
+        webhook_secret=env.get('STRIPE_WEBHOOK_SECRET'),
+        domain=env.get('DOMAIN', 'http://localhost:4242'),  # Default to localhost for testing
+        database_url=env.get('DATABASE_URL', 'sqlite:///users.db'),
+        telegram_transport=env.get('TELEGRAM_TRANSPORT', 'polling'),  # 'polling' or 'webhook'
+        telegram_webhook_secret=env.get('TELEGRAM_WEBHOOK_SECRET'),
+        update_workers=int(env.get('UPDATE_WORKERS', 8)),
+        stripe_timeout=int(env.get('STRIPE_TIMEOUT', 10)),  # seconds per Stripe API request
+        subscription_cache_size=int(env.get('SUBSCRIPTION_CACHE_SIZE', 10000)),
+        subscription_cache_ttl=int(env.get('SUBSCRIPTION_CACHE_TTL', 300)),
+        log_level=env.get('LOG_LEVEL', 'INFO').upper(),
+        log_file=env.get('LOG_FILE', 'bot.log'),  # may contain {pid}; empty for console only
+        log_max_bytes=int(env.get('LOG_MAX_BYTES', 10 * 1024 * 1024)),
+        log_backups=int(env.get('LOG_BACKUPS', 5)),
+        next_step_store=env.get('NEXT_STEP_STORE', 'database'),  # 'database' (shared) or 'memory' (one process)
+    )
+    for name, field in REQUIRED.items():
+        if not getattr(config, field):
+            raise ValueError(f"Missing required environment variable: {name}")
+    if config.telegram_transport == 'webhook' and not config.telegram_webhook_secret:
+        # Without it anyone could POST forged updates, including admin actions, to /telegram
+        raise ValueError("Missing required environment variable: TELEGRAM_WEBHOOK_SECRET (TELEGRAM_TRANSPORT=webhook)")
+    return config
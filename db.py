@@ -0,0 +1,285 @@
+import logging
+import queue
+import re
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+QUERY_SECONDS = metrics.histogram('db_query_seconds', 'Database statement latency by prepared query name or SQL verb')
+POOL_WAIT_SECONDS = metrics.histogram('db_pool_wait_seconds', 'Time spent waiting for a pooled connection when all are busy')
+BEGIN_SECONDS = metrics.histogram('db_begin_seconds', 'Time to open a write transaction, i.e. waiting on the database write lock')
+LOCK_ERRORS = metrics.counter('db_lock_errors_total', 'Statements that failed because the database stayed locked')
+
+POOL_SIZE = 8
+POOL_TIMEOUT = 30  # seconds to wait for a free connection
+BUSY_TIMEOUT = 5000  # milliseconds SQLite waits on a locked database before raising
+
+# Hot queries, written once with '?' placeholders. SQLite keeps compiled statements in each pooled
+# connection's statement cache; on Postgres they are PREPAREd once per connection.
+QUERIES = {
+    'subscription_end': "SELECT subscription_end FROM users WHERE user_id=?",
+    'user_subscription': "SELECT subscription_end, payment_status FROM users WHERE user_id=?",
+    'active_subscribers': "SELECT user_id FROM users WHERE payment_status='active'",
+    # Extends a running subscription from its end, otherwise starts now; banked referral days are added on top
+    'activate_subscription': "INSERT INTO users (user_id, subscription_end, payment_status, payment_link) "
+                             "VALUES (?, ?, 'active', ?) ON CONFLICT (user_id) DO UPDATE SET "
+                             "subscription_end=CASE WHEN users.payment_status='active' AND users.subscription_end > ? "
+                             "THEN users.subscription_end ELSE ? END + ? + users.bonus_days * 86400, "
+                             "payment_status='active', payment_link=excluded.payment_link, bonus_days=0 "
+                             "RETURNING subscription_end",
+    'pending_checkout': "SELECT payment_link, checkout_plan, checkout_expires_at FROM users "
+                        "WHERE user_id=? AND payment_status='pending'",
+    'upsert_pending': "INSERT INTO users (user_id, payment_status, payment_link, checkout_plan, checkout_expires_at) "
+                      "VALUES (?, ?, ?, ?, ?) "
+                      "ON CONFLICT (user_id) DO UPDATE SET payment_status=excluded.payment_status, "
+                      "payment_link=excluded.payment_link, checkout_plan=excluded.checkout_plan, "
+                      "checkout_expires_at=excluded.checkout_expires_at",
+}
+
+
+class ConnectionPool:
+    """Fixed-size, thread-safe pool. Connections are created lazily and handed to one thread at a time."""
+
+    def __init__(self, factory, size=POOL_SIZE, timeout=POOL_TIMEOUT):
+        self.factory = factory
+        self.size = size
+        self.timeout = timeout
+        self.idle = queue.LifoQueue()
+        self.created = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self.lock:
+            if self.created < self.size:
+                self.created += 1
+                create = True
+            else:
+                create = False
+        if create:
+            try:
+                return self.factory()
+            except Exception:
+                with self.lock:
+                    self.created -= 1
+                raise
+        try:
+            with POOL_WAIT_SECONDS.time():
+                return self.idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise TimeoutError(f"No database connection available after {self.timeout}s")
+
+    def release(self, conn, broken=False):
+        if broken:
+            with self.lock:
+                self.created -= 1
+            try:
+                conn.close()
+            except Exception:
+                pass
+            return
+        self.idle.put(conn)
+
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                break
+            with self.lock:
+                self.created -= 1
+
+
+class SQLiteBackend:
+    dialect = 'sqlite'
+
+    def __init__(self, path, busy_timeout=BUSY_TIMEOUT):
+        self.path = path
+        self.busy_timeout = busy_timeout
+
+    def connect(self):
+        conn = sqlite3.connect(self.path, timeout=self.busy_timeout / 1000, check_same_thread=False,
+                               isolation_level=None, cached_statements=256)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA busy_timeout={int(self.busy_timeout)}")
+        return conn
+
+    def begin(self, cursor):
+        # Take the write lock up front so concurrent writers queue on busy_timeout instead of deadlocking
+        cursor.execute("BEGIN IMMEDIATE")
+
+    def translate(self, sql):
+        return sql
+
+    def ddl(self, sql):
+        return sql
+
+    def is_broken(self, conn):
+        return False
+
+    def run_prepared(self, conn, cursor, name, sql, params):
+        cursor.execute(sql, params)
+
+
+class PostgresBackend:
+    dialect = 'postgres'
+
+    def __init__(self, url):
+        import psycopg2
+        self.psycopg2 = psycopg2
+        self.url = url
+        self.prepared = {}  # id(conn) -> set of prepared statement names
+
+    def connect(self):
+        conn = self.psycopg2.connect(self.url)
+        conn.autocommit = True
+        return conn
+
+    def begin(self, cursor):
+        cursor.execute("BEGIN")
+
+    def translate(self, sql):
+        return sql.replace('?', '%s')
+
+    def ddl(self, sql):
+        sql = sql.replace('INTEGER PRIMARY KEY AUTOINCREMENT', 'BIGSERIAL PRIMARY KEY')
+        return re.sub(r'\bINTEGER\b', 'BIGINT', sql)
+
+    def is_broken(self, conn):
+        if conn.closed:
+            self.prepared.pop(id(conn), None)
+            return True
+        return False
+
+    def run_prepared(self, conn, cursor, name, sql, params):
+        names = self.prepared.setdefault(id(conn), set())
+        if name not in names:
+            counter = iter(range(1, len(params) + 1))
+            cursor.execute(f"PREPARE {name} AS " + re.sub(r'\?', lambda m: f"${next(counter)}", sql))
+            names.add(name)
+        if params:
+            cursor.execute(f"EXECUTE {name} ({', '.join(['%s'] * len(params))})", params)
+        else:
+            cursor.execute(f"EXECUTE {name}")
+
+
+class Database:
+    """Pooled access to the users database, on SQLite (default) or Postgres.
+
+    Queries are written with '?' placeholders and translated for the backend. Pass a
+    key of QUERIES instead of SQL text to run one of the prepared hot queries.
+    """
+
+    def __init__(self, backend, pool_size=POOL_SIZE):
+        self.backend = backend
+        self.dialect = backend.dialect
+        self.pool = ConnectionPool(backend.connect, size=pool_size)
+        self.local = threading.local()
+
+    @contextmanager
+    def cursor(self):
+        """Cursor on a pooled connection, reusing the current thread's transaction if one is open."""
+        conn = getattr(self.local, 'conn', None)
+        if conn is not None:
+            yield conn.cursor()
+            return
+        conn = self.pool.acquire()
+        try:
+            yield conn.cursor()
+        finally:
+            self.pool.release(conn, broken=self.backend.is_broken(conn))
+
+    @contextmanager
+    def transaction(self):
+        """Run the enclosed statements atomically; nested calls join the outer transaction."""
+        if getattr(self.local, 'conn', None) is not None:
+            yield
+            return
+        conn = self.pool.acquire()
+        self.local.conn = conn
+        cursor = conn.cursor()
+        try:
+            with timed(BEGIN_SECONDS):
+                self.backend.begin(cursor)
+            yield
+            cursor.execute("COMMIT")
+        except BaseException:
+            try:
+                cursor.execute("ROLLBACK")
+            except Exception as e:
+                logger.error(f"Rollback failed: {e}")
+            raise
+        finally:
+            self.local.conn = None
+            self.pool.release(conn, broken=self.backend.is_broken(conn))
+
+    def _execute(self, cursor, sql, params):
+        params = tuple(params)
+        if sql in QUERIES:
+            with timed(QUERY_SECONDS, query=sql):
+                self.backend.run_prepared(cursor.connection, cursor, sql, QUERIES[sql], params)
+        else:
+            with timed(QUERY_SECONDS, query=statement_verb(sql)):
+                cursor.execute(self.backend.translate(sql), params)
+
+    def execute(self, sql, params=()):
+        """Run a statement and return the number of affected rows."""
+        with self.cursor() as c:
+            self._execute(c, sql, params)
+            return c.rowcount
+
+    def executemany(self, sql, seq_of_params):
+        with self.cursor() as c, timed(QUERY_SECONDS, query=sql if sql in QUERIES else statement_verb(sql)):
+            c.executemany(self.backend.translate(QUERIES.get(sql, sql)), seq_of_params)
+            return c.rowcount
+
+    def fetchone(self, sql, params=()):
+        with self.cursor() as c:
+            self._execute(c, sql, params)
+            return c.fetchone()
+
+    def fetchall(self, sql, params=()):
+        with self.cursor() as c:
+            self._execute(c, sql, params)
+            return c.fetchall()
+
+    def ddl(self, sql):
+        """Run a schema statement, adjusting column types for the backend."""
+        with self.cursor() as c:
+            c.execute(self.backend.ddl(sql))
+
+    def close(self):
+        self.pool.close()
+
+
+@contextmanager
+def timed(histogram, **labels):
+    """Time a statement into `histogram`, counting SQLite 'database is locked' failures."""
+    with histogram.time(**labels):
+        try:
+            yield
+        except sqlite3.OperationalError as e:
+            if 'locked' in str(e):
+                LOCK_ERRORS.inc()
+            raise
+
+
+def statement_verb(sql):
+    """'SELECT', 'INSERT', ... for labelling ad-hoc statements without one series per query text."""
+    return sql.lstrip().split(None, 1)[0].upper() if sql.strip() else 'EMPTY'
+
+
+def connect(url):
+    """Build a Database from a URL: 'sqlite:///path/to/users.db' or 'postgres://...'."""
+    if url.startswith('postgres://') or url.startswith('postgresql://'):
+        return Database(PostgresBackend(url))
+    path = url[len('sqlite:///'):] if url.startswith('sqlite:///') else url
+    return Database(SQLiteBackend(path))
@@ -0,0 +1,17 @@
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '4242')}"
+workers = int(os.getenv('WEB_CONCURRENCY', 2))
+threads = int(os.getenv('WEB_THREADS', 4))
+timeout = 30
+graceful_timeout = 25  # Heroku sends SIGKILL 30s after SIGTERM
+
+# Workers would race rotating a shared log file, so they log to stdout only unless
+# LOG_FILE names a file per process (e.g. LOG_FILE=bot.{pid}.log)
+if '{pid}' not in os.getenv('LOG_FILE', ''):
+    os.environ['LOG_FILE'] = ''
+
+
+def worker_exit(server, worker):
+    import bot
+    bot.shutdown()
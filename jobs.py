@@ -0,0 +1,50 @@
+import logging
+import threading
+
+
+class BackgroundJob:
+    """A periodic service on its own daemon thread: run_once() in a loop until stop_event is set.
+
+    run_once() returns the seconds to wait before the next pass, or None for
+    `interval`; 0 runs the next pass at once. Errors are logged and the next
+    pass comes after `interval`. The wait ends early when `wakeup` is set, so
+    whoever sets stop_event sets `wakeup` too to stop the job promptly.
+    """
+
+    thread_name = 'background-job'
+    title = 'Background job'  # for log lines
+    interval = 60
+    start_delay = 0  # seconds before the first pass
+
+    def __init__(self):
+        self.wakeup = threading.Event()
+
+    def run_once(self):
+        raise NotImplementedError
+
+    def stopped(self):
+        """Called on the job's thread after its last pass."""
+
+    def run(self, stop_event=None):
+        stop_event = stop_event or threading.Event()
+        logger = logging.getLogger(type(self).__module__)
+        logger.info(f"{self.title} started")
+        if self.start_delay:
+            self.wakeup.wait(self.start_delay)
+            self.wakeup.clear()
+        while not stop_event.is_set():
+            try:
+                delay = self.run_once()
+            except Exception as e:
+                logger.error(f"{self.title} error: {e}")
+                delay = None
+            if delay != 0:
+                self.wakeup.wait(self.interval if delay is None else delay)
+                self.wakeup.clear()
+        self.stopped()
+        logger.info(f"{self.title} stopped")
+
+    def start(self, stop_event=None):
+        thread = threading.Thread(target=self.run, args=(stop_event,), name=self.thread_name, daemon=True)
+        thread.start()
+        return thread
@@ -0,0 +1,89 @@
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+
+from jobs import BackgroundJob
+
+logger = logging.getLogger(__name__)
+
+LEASE_TTL = 30  # seconds a leader keeps its lease without renewing
+RENEW_INTERVAL = 10
+STOP_TIMEOUT = 15  # seconds to wait for a service to stop after losing the lease
+
+
+def process_id():
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+class LeaderLease:
+    """A named, expiring lease in the leases table; at most one holder at a time."""
+
+    def __init__(self, db, name, holder=None, ttl=LEASE_TTL):
+        self.db = db
+        self.name = name
+        self.holder = holder or process_id()
+        self.ttl = ttl
+
+    def acquire(self):
+        """Take the lease if it is free or expired, or renew it if we hold it. Returns True while held."""
+        now = int(time.time())
+        row = self.db.fetchone("INSERT INTO leases (name, holder, expires_at) VALUES (?, ?, ?) "
+                               "ON CONFLICT (name) DO UPDATE SET holder=excluded.holder, expires_at=excluded.expires_at "
+                               "WHERE leases.holder = excluded.holder OR leases.expires_at < ? RETURNING holder",
+                               (self.name, self.holder, now + self.ttl, now))
+        return row is not None
+
+    def release(self):
+        self.db.execute("DELETE FROM leases WHERE name=? AND holder=?", (self.name, self.holder))
+
+
+class LeaderOnly(BackgroundJob):
+    """Runs a background service only in the process holding its lease.
+
+    `service` is a BackgroundJob such as ExpirySweeper or BroadcastQueue, or
+    anything else with start(stop_event) -> thread and a `wakeup` event. Every
+    process runs a LeaderOnly for it; one wins the lease and starts the service,
+    the others keep trying and take over once the leader stops renewing. A leader that
+    can't renew stops its service before the lease can expire.
+    """
+
+    def __init__(self, db, name, service, ttl=LEASE_TTL, renew_interval=RENEW_INTERVAL):
+        super().__init__()
+        self.name = name
+        self.service = service
+        self.lease = LeaderLease(db, name, ttl=ttl)
+        self.thread_name = f'leader-{name}'
+        self.title = f"Leader election for {name}"
+        self.interval = renew_interval
+        self.term, self.thread = None, None
+
+    def run_once(self):
+        try:
+            leader = self.lease.acquire()
+        except Exception as e:
+            logger.error(f"Error renewing {self.name} lease: {e}")
+            leader = False
+        if leader and self.thread is None:
+            logger.info(f"Acquired {self.name} lease, starting")
+            self.term = threading.Event()
+            self.thread = self.service.start(self.term)
+        elif not leader and self.thread is not None:
+            logger.warning(f"Lost {self.name} lease, stopping")
+            self._stop()
+
+    def stopped(self):
+        if self.thread is not None:
+            self._stop()
+            try:
+                self.lease.release()
+            except Exception as e:
+                logger.error(f"Error releasing {self.name} lease: {e}")
+
+    def _stop(self):
+        self.term.set()
+        self.service.wakeup.set()
+        self.thread.join(timeout=STOP_TIMEOUT)
+        self.term, self.thread = None, None
@@ -0,0 +1,293 @@
+import logging
+import time
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+MIGRATION_LOCK = 72150501  # Postgres advisory lock key held while migrating
+
+
+def m001_baseline(db):
+    db.ddl('''CREATE TABLE IF NOT EXISTS users
+              (user_id INTEGER PRIMARY KEY,
+               subscription_end TEXT,
+               payment_status TEXT,
+               payment_link TEXT,
+               referral_code TEXT,
+               referred_by INTEGER)''')
+    db.ddl('''CREATE TABLE IF NOT EXISTS broadcast_jobs
+              (job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+               text TEXT NOT NULL,
+               admin_chat_id INTEGER,
+               status_message_id INTEGER,
+               status TEXT NOT NULL,
+               total INTEGER NOT NULL,
+               created_at INTEGER NOT NULL,
+               finished_at INTEGER)''')
+    db.ddl('''CREATE TABLE IF NOT EXISTS broadcast_recipients
+              (job_id INTEGER NOT NULL,
+               user_id INTEGER NOT NULL,
+               state TEXT NOT NULL,
+               claim_token TEXT,
+               claimed_at INTEGER,
+               error TEXT,
+               PRIMARY KEY (job_id, user_id))''')
+    db.ddl("CREATE INDEX IF NOT EXISTS idx_broadcast_recipients_state ON broadcast_recipients (state, job_id)")
+
+
+def m002_subscription_end_epoch(db):
+    """Store subscription_end as integer epoch seconds instead of '%Y-%m-%d %H:%M:%S' text."""
+    db.ddl("ALTER TABLE users ADD COLUMN subscription_end_epoch INTEGER")
+    rows = db.fetchall("SELECT user_id, subscription_end FROM users WHERE subscription_end IS NOT NULL")
+    updates = []
+    for user_id, value in rows:
+        try:
+            # Stored values were written from datetime.now(), so they are interpreted as local time
+            updates.append((int(datetime.strptime(value, '%Y-%m-%d %H:%M:%S').timestamp()), user_id))
+        except (TypeError, ValueError):
+            logger.warning(f"Dropping unparseable subscription_end {value!r} for user {user_id}")
+    if updates:
+        db.executemany("UPDATE users SET subscription_end_epoch=? WHERE user_id=?", updates)
+    db.ddl("ALTER TABLE users DROP COLUMN subscription_end")
+    db.ddl("ALTER TABLE users RENAME COLUMN subscription_end_epoch TO subscription_end")
+
+
+def m003_users_indexes(db):
+    # Covers the active-subscriber list and the expiry sweep (user_id is carried in the index)
+    db.ddl("CREATE INDEX IF NOT EXISTS idx_users_status_end ON users (payment_status, subscription_end, user_id)")
+    # Older codes were time-stamped per press, so duplicates are unlikely; keep the lowest user_id's copy
+    db.execute("UPDATE users SET referral_code=NULL WHERE referral_code IS NOT NULL AND user_id NOT IN "
+               "(SELECT MIN(user_id) FROM users WHERE referral_code IS NOT NULL GROUP BY referral_code)")
+    db.ddl("CREATE UNIQUE INDEX IF NOT EXISTS idx_users_referral_code ON users (referral_code)")
+
+
+def m004_expiry_reminders(db):
+    # subscription_end the 24h reminder was sent for; a renewal changes subscription_end and re-arms it
+    db.ddl("ALTER TABLE users ADD COLUMN reminded_end INTEGER")
+
+
+def m005_stripe_events(db):
+    db.ddl('''CREATE TABLE IF NOT EXISTS stripe_events
+              (event_id TEXT PRIMARY KEY,
+               type TEXT NOT NULL,
+               payload TEXT NOT NULL,
+               status TEXT NOT NULL,
+               attempts INTEGER NOT NULL DEFAULT 0,
+               error TEXT,
+               received_at INTEGER NOT NULL,
+               claimed_at INTEGER,
+               processed_at INTEGER)''')
+    db.ddl("CREATE INDEX IF NOT EXISTS idx_stripe_events_status ON stripe_events (status, received_at)")
+
+
+def m006_profiles(db):
+    db.ddl('''CREATE TABLE IF NOT EXISTS profiles
+              (user_id INTEGER PRIMARY KEY,
+               first_name TEXT,
+               username TEXT,
+               fetched_at INTEGER NOT NULL)''')
+
+
+def m007_picks(db):
+    db.ddl('''CREATE TABLE IF NOT EXISTS picks
+              (sport TEXT NOT NULL,
+               pick_date TEXT NOT NULL,
+               version INTEGER NOT NULL,
+               body TEXT NOT NULL,
+               published_by INTEGER,
+               published_at INTEGER NOT NULL,
+               PRIMARY KEY (sport, pick_date, version))''')
+    # Seed with the picks that used to be hard-coded in bot.SPORTS_PICKS
+    now = int(time.time())
+    pick_date = datetime.now().strftime('%Y-%m-%d')
+    db.executemany("INSERT INTO picks (sport, pick_date, version, body, published_at) VALUES (?, ?, 1, ?, ?)", [
+        ('nba', pick_date, "Lakers +5.5 (-110)\nWarriors ML (-120)", now),
+        ('nfl', pick_date, "Chiefs -3 (-105)\nBills Over 48.5 (-115)", now),
+        ('mlb', pick_date, "Yankees ML (-130)\nDodgers -1.5 (+150)", now),
+        ('parlay', pick_date, "Lakers ML + Chiefs -3 (+250)", now),
+    ])
+
+
+def m008_checkout_reuse(db):
+    # Plan and Stripe expiry of the session in payment_link, so a pending checkout can be reused
+    db.ddl("ALTER TABLE users ADD COLUMN checkout_plan TEXT")
+    db.ddl("ALTER TABLE users ADD COLUMN checkout_expires_at INTEGER")
+
+
+def m009_referrals(db):
+    db.ddl('''CREATE TABLE IF NOT EXISTS referral_codes
+              (user_id INTEGER PRIMARY KEY,
+               code TEXT NOT NULL,
+               created_at INTEGER NOT NULL)''')
+    db.ddl("CREATE UNIQUE INDEX IF NOT EXISTS idx_referral_codes_code ON referral_codes (code)")
+    db.ddl('''CREATE TABLE IF NOT EXISTS referral_events
+              (event_id INTEGER PRIMARY KEY AUTOINCREMENT,
+               kind TEXT NOT NULL,
+               referrer_id INTEGER NOT NULL,
+               referred_id INTEGER,
+               bonus_days INTEGER,
+               created_at INTEGER NOT NULL)''')
+    # At most one 'joined' and one 'converted' event per referred user ('rewarded' rows have no referred_id)
+    db.ddl("CREATE UNIQUE INDEX IF NOT EXISTS idx_referral_events_referred ON referral_events (referred_id, kind)")
+    db.ddl('''CREATE TABLE IF NOT EXISTS job_cursors
+              (name TEXT PRIMARY KEY,
+               last_id INTEGER NOT NULL)''')
+    # Carry over codes and referrals stored on users; those columns are no longer written
+    now = int(time.time())
+    db.execute("INSERT INTO referral_codes (user_id, code, created_at) "
+               "SELECT user_id, referral_code, ? FROM users WHERE referral_code IS NOT NULL", (now,))
+    db.execute("INSERT INTO referral_events (kind, referrer_id, referred_id, created_at) "
+               "SELECT 'joined', referred_by, user_id, ? FROM users "
+               "WHERE referred_by IS NOT NULL AND referred_by != user_id", (now,))
+
+
+def m010_shared_state(db):
+    # Pending next-step handlers, so any bot process can take a chat's reply
+    db.ddl('''CREATE TABLE IF NOT EXISTS step_handlers
+              (step_id INTEGER PRIMARY KEY AUTOINCREMENT,
+               chat_id INTEGER NOT NULL,
+               callback TEXT NOT NULL,
+               args TEXT NOT NULL,
+               kwargs TEXT NOT NULL,
+               created_at INTEGER NOT NULL)''')
+    db.ddl("CREATE INDEX IF NOT EXISTS idx_step_handlers_chat ON step_handlers (chat_id)")
+    # Leader leases for jobs that must run in one process at a time
+    db.ddl('''CREATE TABLE IF NOT EXISTS leases
+              (name TEXT PRIMARY KEY,
+               holder TEXT NOT NULL,
+               expires_at INTEGER NOT NULL)''')
+
+
+def m011_subscription_events(db):
+    db.ddl('''CREATE TABLE IF NOT EXISTS subscription_events
+              (event_id INTEGER PRIMARY KEY AUTOINCREMENT,
+               kind TEXT NOT NULL,
+               user_id INTEGER NOT NULL,
+               plan TEXT,
+               days INTEGER,
+               amount_cents INTEGER NOT NULL DEFAULT 0,
+               ref TEXT,
+               created_at INTEGER NOT NULL)''')
+    # Daily rollups of subscription_events, maintained by analytics.Analytics.roll_up
+    db.ddl('''CREATE TABLE IF NOT EXISTS daily_stats
+              (day INTEGER NOT NULL,
+               kind TEXT NOT NULL,
+               plan TEXT NOT NULL,
+               events INTEGER NOT NULL,
+               amount_cents INTEGER NOT NULL,
+               PRIMARY KEY (day, kind, plan))''')
+    db.ddl('''CREATE TABLE IF NOT EXISTS daily_snapshots
+              (day INTEGER PRIMARY KEY,
+               active INTEGER NOT NULL,
+               pending INTEGER NOT NULL,
+               taken_at INTEGER NOT NULL)''')
+
+
+def m012_rollup_flags(db):
+    # Rolled-up events are flagged instead of tracked by the job_cursors high-water mark
+    db.ddl("ALTER TABLE subscription_events ADD COLUMN rolled_up INTEGER NOT NULL DEFAULT 0")
+    db.execute("UPDATE subscription_events SET rolled_up=1 WHERE event_id <= "
+               "COALESCE((SELECT last_id FROM job_cursors WHERE name='daily_stats'), 0)")
+    db.ddl("CREATE INDEX IF NOT EXISTS idx_subscription_events_unrolled ON subscription_events (event_id) "
+           "WHERE rolled_up = 0")
+
+
+def m013_referral_flags(db):
+    # Rewarded conversions are flagged instead of tracked by a high-water mark, which retires job_cursors
+    db.ddl("ALTER TABLE referral_events ADD COLUMN rewarded INTEGER NOT NULL DEFAULT 0")
+    db.execute("UPDATE referral_events SET rewarded=1 WHERE kind='converted' AND event_id <= "
+               "COALESCE((SELECT last_id FROM job_cursors WHERE name='referral_rewards'), 0)")
+    db.ddl("CREATE INDEX IF NOT EXISTS idx_referral_events_unrewarded ON referral_events (event_id) "
+           "WHERE kind = 'converted' AND rewarded = 0")
+    db.ddl("DROP TABLE IF EXISTS job_cursors")
+    # Bonus days for a referrer with an open checkout are banked and added when the payment activates
+    db.ddl("ALTER TABLE users ADD COLUMN bonus_days INTEGER NOT NULL DEFAULT 0")
+    # Pending rows given an end date by earlier passes bank the remaining days instead
+    now = int(time.time())
+    db.execute("UPDATE users SET bonus_days=(subscription_end - ? + 86399) / 86400, subscription_end=? "
+               "WHERE payment_status='pending' AND subscription_end > ?", (now, now, now))
+
+
+MIGRATIONS = [
+    (1, m001_baseline),
+    (2, m002_subscription_end_epoch),
+    (3, m003_users_indexes),
+    (4, m004_expiry_reminders),
+    (5, m005_stripe_events),
+    (6, m006_profiles),
+    (7, m007_picks),
+    (8, m008_checkout_reuse),
+    (9, m009_referrals),
+    (10, m010_shared_state),
+    (11, m011_subscription_events),
+    (12, m012_rollup_flags),
+    (13, m013_referral_flags),
+]
+
+# Hot queries and the index each must use, checked with EXPLAIN QUERY PLAN after migrating SQLite databases
+EXPECTED_PLANS = [
+    ("SELECT user_id FROM users WHERE payment_status='active'", 'idx_users_status_end'),
+    ("UPDATE users SET payment_status='expired' WHERE subscription_end < ? AND payment_status='active'",
+     'idx_users_status_end'),
+    ("SELECT user_id FROM referral_codes WHERE code=?", 'idx_referral_codes_code'),
+    ("SELECT referrer_id, referred_id FROM referral_events WHERE referred_id=? AND kind='joined'",
+     'idx_referral_events_referred'),
+    ("SELECT 1 FROM step_handlers WHERE chat_id=? LIMIT 1", 'idx_step_handlers_chat'),
+    ("SELECT created_at FROM subscription_events WHERE rolled_up=0", 'idx_subscription_events_unrolled'),
+    ("SELECT referrer_id FROM referral_events WHERE kind='converted' AND rewarded=0",
+     'idx_referral_events_unrewarded'),
+]
+
+
+def current_version(db):
+    row = db.fetchone("SELECT MAX(version) FROM schema_migrations")
+    return row[0] or 0
+
+
+def lock_migrations(db):
+    """Serialize migrating processes until the current transaction ends.
+
+    SQLite transactions already start with BEGIN IMMEDIATE, which takes the write lock;
+    a Postgres BEGIN takes no lock, so concurrent workers would otherwise both apply
+    the same migration.
+    """
+    if db.dialect == 'postgres':
+        db.fetchone("SELECT pg_advisory_xact_lock(?)", (MIGRATION_LOCK,))
+
+
+def migrate(db):
+    """Apply pending migrations in order, each in its own transaction. Safe to run from several processes."""
+    with db.transaction():
+        lock_migrations(db)
+        db.ddl('''CREATE TABLE IF NOT EXISTS schema_migrations
+                  (version INTEGER PRIMARY KEY,
+                   name TEXT NOT NULL,
+                   applied_at INTEGER NOT NULL)''')
+    for version, migration in MIGRATIONS:
+        with db.transaction():
+            lock_migrations(db)
+            # Re-read under the lock so a concurrent process doesn't apply it twice
+            if version <= current_version(db):
+                continue
+            migration(db)
+            db.execute("INSERT INTO schema_migrations (version, name, applied_at) VALUES (?, ?, ?)",
+                       (version, migration.__name__, int(time.time())))
+        logger.info(f"Applied migration {version}: {migration.__name__}")
+    return current_version(db)
+
+
+def query_plan(db, sql):
+    params = (None,) * sql.count('?')
+    return ' | '.join(row[-1] for row in db.fetchall(f"EXPLAIN QUERY PLAN {sql}", params))
+
+
+def check_query_plans(db):
+    """Return (sql, plan) for every hot query whose plan doesn't use its expected index."""
+    if db.dialect != 'sqlite':
+        return []
+    problems = []
+    for sql, index in EXPECTED_PLANS:
+        plan = query_plan(db, sql)
+        if index not in plan:
+            problems.append((sql, plan))
+    return problems
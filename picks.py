@@ -0,0 +1,71 @@
+import logging
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime
+
+from jobs import BackgroundJob
+
+logger = logging.getLogger(__name__)
+
+RELOAD_INTERVAL = 30  # seconds between checks for picks published by other processes
+
+Picks = namedtuple('Picks', ['sport', 'pick_date', 'version', 'lines'])
+
+
+class PicksStore(BackgroundJob):
+    """Versioned picks per (sport, date), persisted in the picks table.
+
+    Every publish appends a new version. Readers use get(), a single lookup in an
+    immutable snapshot dict ({sport: Picks} for each sport's latest version); a
+    publish builds a fresh snapshot and swaps the reference, so readers never need
+    a lock and always see a consistent set of picks.
+    """
+
+    thread_name = 'picks-reloader'
+    title = 'Picks reloader'
+    interval = RELOAD_INTERVAL
+    start_delay = RELOAD_INTERVAL  # setup() has just loaded the snapshot
+
+    def __init__(self, db):
+        super().__init__()
+        self.db = db
+        self.snapshot = {}
+        self.snapshot_marker = None
+        self.write_lock = threading.Lock()
+
+    def get(self, sport):
+        return self.snapshot.get(sport)
+
+    def publish(self, sport, lines, published_by=None, pick_date=None):
+        """Store a new version of `sport`'s picks and swap in a new snapshot. Returns the Picks entry."""
+        pick_date = pick_date or datetime.now().strftime('%Y-%m-%d')
+        lines = tuple(line.strip() for line in lines if line.strip())
+        with self.db.transaction():
+            version = self.db.fetchone("SELECT COALESCE(MAX(version), 0) + 1 FROM picks WHERE sport=? AND pick_date=?",
+                                       (sport, pick_date))[0]
+            self.db.execute("INSERT INTO picks (sport, pick_date, version, body, published_by, published_at) "
+                            "VALUES (?, ?, ?, ?, ?, ?)",
+                            (sport, pick_date, version, '\n'.join(lines), published_by, int(time.time())))
+        logger.info(f"Published {sport} picks for {pick_date} (version {version})")
+        self.reload()
+        return self.get(sport)
+
+    def load_marker(self):
+        return tuple(self.db.fetchone("SELECT COUNT(*), MAX(published_at) FROM picks"))
+
+    def reload(self):
+        """Rebuild the snapshot from each sport's most recent date and version."""
+        with self.write_lock:
+            marker = self.load_marker()
+            rows = self.db.fetchall("SELECT p.sport, p.pick_date, p.version, p.body FROM picks p "
+                                    "WHERE NOT EXISTS (SELECT 1 FROM picks q WHERE q.sport = p.sport AND "
+                                    "(q.pick_date > p.pick_date OR (q.pick_date = p.pick_date AND q.version > p.version)))")
+            self.snapshot = {sport: Picks(sport, pick_date, version, tuple(body.split('\n')) if body else ())
+                             for sport, pick_date, version, body in rows}
+            self.snapshot_marker = marker
+
+    def run_once(self):
+        """Pick up publishes made by other processes."""
+        if self.load_marker() != self.snapshot_marker:
+            self.reload()
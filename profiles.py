@@ -0,0 +1,117 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from jobs import BackgroundJob
+
+logger = logging.getLogger(__name__)
+
+PROFILE_TTL = 24 * 3600  # seconds before a stored Telegram profile is refreshed
+REFRESH_WORKERS = 4
+REFRESH_BATCH = 200  # stale profiles refreshed per background pass
+REFRESH_INTERVAL = 600  # seconds between background passes
+
+
+class ProfileCache(BackgroundJob):
+    """Telegram first names/usernames persisted in the profiles table.
+
+    Reads never call Telegram: get_many() answers from the table and schedules a
+    background refresh (bot.get_chat on a small pool) for ids that are missing or
+    older than PROFILE_TTL, so the next view has them.
+    """
+
+    thread_name = 'profile-refresher'
+    title = 'Profile refresher'
+    interval = REFRESH_INTERVAL
+
+    def __init__(self, db, bot, ttl=PROFILE_TTL, workers=REFRESH_WORKERS):
+        super().__init__()
+        self.db = db
+        self.bot = bot
+        self.ttl = ttl
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='profile-refresh')
+        self.in_flight = set()
+        self.lock = threading.Lock()
+
+    def remember(self, user):
+        """Store a profile we already have (e.g. message.from_user) without an API call.
+
+        Runs on every /start, so it only writes when the stored profile is missing, stale
+        or different; the usual case is a single primary-key read.
+        """
+        row = self.db.fetchone("SELECT first_name, username, fetched_at FROM profiles WHERE user_id=?", (user.id,))
+        if row and row[:2] == (user.first_name, user.username) and row[2] >= time.time() - self.ttl:
+            return False
+        self.store([(user.id, user.first_name, user.username, int(time.time()))])
+        return True
+
+    def store(self, rows):
+        self.db.executemany("INSERT INTO profiles (user_id, first_name, username, fetched_at) VALUES (?, ?, ?, ?) "
+                            "ON CONFLICT (user_id) DO UPDATE SET first_name=excluded.first_name, "
+                            "username=excluded.username, fetched_at=excluded.fetched_at", rows)
+
+    def get_many(self, user_ids):
+        """Map user_id -> (first_name, username) for the ids we have; refresh stale ones in the background."""
+        user_ids = list(user_ids)
+        if not user_ids:
+            return {}
+        rows = self.db.fetchall(f"SELECT user_id, first_name, username, fetched_at FROM profiles "
+                                f"WHERE user_id IN ({', '.join('?' * len(user_ids))})", user_ids)
+        cutoff = time.time() - self.ttl
+        profiles = {user_id: (first_name, username) for user_id, first_name, username, _ in rows}
+        fresh = {user_id for user_id, _, _, fetched_at in rows if fetched_at >= cutoff}
+        self.refresh([user_id for user_id in user_ids if user_id not in fresh])
+        return profiles
+
+    def refresh(self, user_ids):
+        with self.lock:
+            user_ids = [user_id for user_id in user_ids if user_id not in self.in_flight]
+            self.in_flight.update(user_ids)
+        if user_ids:
+            threading.Thread(target=self._refresh, args=(user_ids,), name='profile-refresh-batch', daemon=True).start()
+
+    def _refresh(self, user_ids):
+        try:
+            now = int(time.time())
+            fetched, missed = [], []
+            for user_id, chat in zip(user_ids, self.executor.map(self._fetch, user_ids)):
+                if chat:
+                    fetched.append((user_id, chat.first_name, chat.username, now))
+                else:
+                    missed.append((user_id, now))
+            if fetched:
+                self.store(fetched)
+            if missed:
+                # Remember the miss (keeping any older names) so unreachable users aren't re-fetched on every view
+                self.db.executemany("INSERT INTO profiles (user_id, fetched_at) VALUES (?, ?) "
+                                    "ON CONFLICT (user_id) DO UPDATE SET fetched_at=excluded.fetched_at", missed)
+        except Exception as e:
+            logger.error(f"Error refreshing Telegram profiles: {e}")
+        finally:
+            with self.lock:
+                self.in_flight.difference_update(user_ids)
+
+    def refresh_stale(self):
+        """Refresh one batch of users whose profile is missing or older than the TTL. Returns the batch size."""
+        rows = self.db.fetchall("SELECT u.user_id FROM users u LEFT JOIN profiles p ON p.user_id = u.user_id "
+                                "WHERE p.user_id IS NULL OR p.fetched_at < ? LIMIT ?",
+                                (int(time.time() - self.ttl), REFRESH_BATCH))
+        user_ids = [row[0] for row in rows]
+        with self.lock:
+            user_ids = [user_id for user_id in user_ids if user_id not in self.in_flight]
+            self.in_flight.update(user_ids)
+        if user_ids:
+            self._refresh(user_ids)
+        return len(user_ids)
+
+    def run_once(self):
+        # A full batch means more are stale, so go again straight away
+        return 0 if self.refresh_stale() >= REFRESH_BATCH else None
+
+    def _fetch(self, user_id):
+        try:
+            return self.bot.get_chat(user_id)
+        except Exception as e:
+            logger.error(f"Error fetching Telegram info for user {user_id}: {e}")
+            return None
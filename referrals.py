@@ -0,0 +1,140 @@
+import logging
+import secrets
+import time
+
+from jobs import BackgroundJob
+
+logger = logging.getLogger(__name__)
+
+CODE_ALPHABET = 'ABCDEFGHJKLMNPQRSTUVWXYZ23456789'  # no 0/O or 1/I, codes get typed by hand
+CODE_LENGTH = 6
+CODE_ATTEMPTS = 10
+BONUS_DAYS = 3  # per referred user whose first payment goes through
+REWARD_INTERVAL = 3600  # seconds between reward passes
+JOINED_TEXT = "🎁 Someone used your referral code! You’ll get bonus days once they subscribe!"
+REWARD_TEXT = "🎉 Your referrals subscribed! {days} bonus days were added to your VIP access."
+
+
+class ReferralEngine(BackgroundJob):
+    """Referral codes, the referral event log and periodic reward accrual.
+
+    Each user gets one code for good (referral_codes, looked up through unique
+    indexes in both directions). Using a code appends a 'joined' event and the
+    referred user's first payment appends 'converted'; both are unique per
+    referred user. accrue() turns every 'converted' event not yet rewarded into
+    bonus days for the referrers in a single transaction and records a
+    'rewarded' event per referrer (and, with `analytics`, a 'referral_bonus'
+    subscription event). A referrer with a checkout open banks the days in
+    users.bonus_days; activating the subscription adds them.
+    """
+
+    thread_name = 'referral-rewards'
+    title = 'Referral rewards job'
+    interval = REWARD_INTERVAL
+
+    def __init__(self, db, engine, on_rewarded=None, bonus_days=BONUS_DAYS, analytics=None):
+        super().__init__()
+        self.db = db
+        self.engine = engine
+        self.on_rewarded = on_rewarded
+        self.analytics = analytics
+        self.bonus_days = bonus_days
+
+    def code_for(self, user_id):
+        """The user's referral code, minting one on first use."""
+        row = self.db.fetchone("SELECT code FROM referral_codes WHERE user_id=?", (user_id,))
+        if row:
+            return row[0]
+        for _ in range(CODE_ATTEMPTS):
+            code = 'REF' + ''.join(secrets.choice(CODE_ALPHABET) for _ in range(CODE_LENGTH))
+            # Conflicts on either the user or the code; re-reading tells which one happened
+            self.db.execute("INSERT INTO referral_codes (user_id, code, created_at) VALUES (?, ?, ?) "
+                            "ON CONFLICT DO NOTHING", (user_id, code, int(time.time())))
+            row = self.db.fetchone("SELECT code FROM referral_codes WHERE user_id=?", (user_id,))
+            if row:
+                return row[0]
+        raise RuntimeError(f"No free referral code after {CODE_ATTEMPTS} attempts")
+
+    def referrer_for_code(self, code):
+        row = self.db.fetchone("SELECT user_id FROM referral_codes WHERE code=?", (code.strip().upper(),))
+        return row[0] if row else None
+
+    def join(self, user_id, code):
+        """Record that `user_id` was referred through `code`. Returns the referrer, or None if the
+        code is unknown, the user's own, or the user was already referred."""
+        referrer = self.referrer_for_code(code)
+        if referrer is None or referrer == user_id:
+            return None
+        added = self.db.execute("INSERT INTO referral_events (kind, referrer_id, referred_id, created_at) "
+                                "VALUES ('joined', ?, ?, ?) ON CONFLICT DO NOTHING",
+                                (referrer, user_id, int(time.time())))
+        if not added:
+            return None
+        self.notify_later([referrer], JOINED_TEXT)
+        logger.info(f"User {user_id} joined through referral code {code} from {referrer}")
+        return referrer
+
+    def record_conversion(self, user_id):
+        """Log the first payment of a referred user; later payments and unreferred users are ignored."""
+        return self.db.execute("INSERT INTO referral_events (kind, referrer_id, referred_id, created_at) "
+                               "SELECT 'converted', referrer_id, referred_id, ? FROM referral_events "
+                               "WHERE referred_id=? AND kind='joined' ON CONFLICT DO NOTHING",
+                               (int(time.time()), user_id)) > 0
+
+    def accrue(self):
+        """Credit bonus days for conversions not yet rewarded. Returns {referrer_id: days}."""
+        now = int(time.time())
+        with self.db.transaction():
+            # Conversions are claimed by flag rather than past an id high-water mark: on Postgres a lower
+            # event_id can commit after a pass has seen a higher one. A concurrent pass waits on the
+            # row locks and then skips the rows this one claimed.
+            rows = self.db.fetchall("UPDATE referral_events SET rewarded=1 WHERE kind='converted' AND rewarded=0 "
+                                    "RETURNING referrer_id")
+            rewards = {}
+            for (referrer,) in rows:
+                rewards[referrer] = rewards.get(referrer, 0) + self.bonus_days
+            if rewards:
+                # Extend running subscriptions; lapsed or unknown referrers get the days starting now.
+                # A pending checkout keeps its row untouched apart from the banked days, so it stays
+                # unsubscribed until the payment activates it with the bonus added.
+                self.db.executemany("INSERT INTO users (user_id, subscription_end, payment_status) "
+                                    "VALUES (?, ?, 'active') ON CONFLICT (user_id) DO UPDATE SET "
+                                    "subscription_end=CASE WHEN users.payment_status='pending' "
+                                    "THEN users.subscription_end WHEN users.subscription_end > ? "
+                                    "THEN users.subscription_end + ? ELSE ? END, "
+                                    "bonus_days=users.bonus_days + CASE WHEN users.payment_status='pending' "
+                                    "THEN ? ELSE 0 END, "
+                                    "payment_status=CASE WHEN users.payment_status='pending' THEN 'pending' "
+                                    "ELSE 'active' END",
+                                    [(referrer, now + days * 86400, now, days * 86400, now + days * 86400, days)
+                                     for referrer, days in rewards.items()])
+                self.db.executemany("INSERT INTO referral_events (kind, referrer_id, bonus_days, created_at) "
+                                    "VALUES ('rewarded', ?, ?, ?)",
+                                    [(referrer, days, now) for referrer, days in rewards.items()])
+                if self.analytics:
+                    for referrer, days in rewards.items():
+                        self.analytics.record('referral_bonus', referrer, days=days)
+        if rewards:
+            logger.info(f"Credited referral bonus days to {len(rewards)} referrers")
+            if self.on_rewarded:
+                self.on_rewarded(list(rewards))
+            by_days = {}
+            for referrer, days in rewards.items():
+                by_days.setdefault(days, []).append(referrer)
+            for days, referrers in by_days.items():
+                self.notify_later(referrers, REWARD_TEXT.format(days=days))
+        return rewards
+
+    def notify_later(self, chat_ids, text):
+        """Queue rate-limited sends on the broadcast engine's pool without holding up the caller."""
+        for chat_id in chat_ids:
+            self.engine.executor.submit(self._send, chat_id, text)
+
+    def _send(self, chat_id, text):
+        try:
+            self.engine.send_one(chat_id, text)
+        except Exception as e:
+            logger.error(f"Error sending referral notice to {chat_id}: {e}")
+
+    def run_once(self):
+        self.accrue()
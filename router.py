@@ -0,0 +1,69 @@
+class CallbackContext:
+    """Per-update state shared by middleware and the handler.
+
+    `subscribed` is resolved on first access and then reused, so a handler and its
+    middleware check the subscription at most once per callback.
+    """
+
+    def __init__(self, call, admin_id, subscription_check):
+        self.call = call
+        self.user_id = call.from_user.id
+        self.data = call.data
+        self.is_admin = self.user_id == admin_id
+        self.route = None  # name of the handler that matched, set by CallbackRouter.dispatch
+        self._subscription_check = subscription_check
+        self._subscribed = None
+
+    @property
+    def subscribed(self):
+        if self._subscribed is None:
+            self._subscribed = self._subscription_check(self.user_id)
+        return self._subscribed
+
+
+class CallbackRouter:
+    """Routes callback data to handlers: exact matches via dict lookup, then registered prefixes.
+
+    Each route can carry middleware, callables `middleware(ctx, handler)` that either call
+    handler(ctx) or answer the callback themselves.
+    """
+
+    def __init__(self):
+        self.exact = {}  # data -> (name, handler)
+        self.prefixes = []  # (prefix, (name, handler)), longest prefix first
+
+    def route(self, *data, prefix=None, middleware=()):
+        def decorator(func):
+            handler = (func.__name__, self._wrap(func, middleware))
+            for value in data:
+                self.exact[value] = handler
+            if prefix:
+                self.prefixes.append((prefix, handler))
+                self.prefixes.sort(key=lambda item: len(item[0]), reverse=True)
+            return func
+        return decorator
+
+    @staticmethod
+    def _wrap(func, middleware):
+        handler = func
+        for layer in reversed(middleware):
+            handler = (lambda layer, inner: lambda ctx: layer(ctx, inner))(layer, handler)
+        return handler
+
+    def resolve(self, data):
+        """(route name, wrapped handler) for `data`, or None."""
+        route = self.exact.get(data)
+        if route is None:
+            for prefix, prefixed in self.prefixes:
+                if data.startswith(prefix):
+                    return prefixed
+        return route
+
+    def dispatch(self, ctx):
+        """Run the handler for ctx.data. Returns False when no route matches."""
+        route = self.resolve(ctx.data)
+        if route is None:
+            return False
+        ctx.route, handler = route
+        handler(ctx)
+        return True
@@ -0,0 +1,91 @@
+import logging
+import time
+
+from jobs import BackgroundJob
+
+logger = logging.getLogger(__name__)
+
+REMINDER_WINDOW = 24 * 3600  # remind users this many seconds before their subscription ends
+REMINDER_BATCH = 500  # reminders sent per pass
+MAX_SLEEP = 300  # upper bound between passes so newly added short subscriptions are picked up
+# Checkout is only offered to users without a running subscription, so point them at renewing once it ends
+REMINDER_TEXT = ("⏰ Your VIP subscription expires in less than 24 hours! "
+                 "Once it ends, send /start to renew and keep getting premium picks.")
+
+
+class ExpirySweeper(BackgroundJob):
+    """Expires subscriptions and sends 24h reminders as their times come due.
+
+    Each pass only touches rows that are actually due, found through the
+    (payment_status, subscription_end) index, then sleeps until the next
+    expiry or reminder time read from the same index. With `analytics`, every
+    expiry is logged as an 'expired' event in the same transaction.
+    """
+
+    thread_name = 'expiry-sweeper'
+    title = 'Expiry sweeper'
+    interval = MAX_SLEEP
+
+    def __init__(self, db, engine, on_expired=None, analytics=None):
+        super().__init__()
+        self.db = db
+        self.engine = engine
+        self.on_expired = on_expired
+        self.analytics = analytics
+
+    def expire_due(self, now):
+        with self.db.transaction():
+            rows = self.db.fetchall("UPDATE users SET payment_status='expired' "
+                                    "WHERE payment_status='active' AND subscription_end <= ? RETURNING user_id",
+                                    (now,))
+            user_ids = [row[0] for row in rows]
+            if user_ids and self.analytics:
+                self.analytics.record('expired', user_ids)
+        if user_ids:
+            logger.info(f"Expired {len(user_ids)} subscriptions")
+            if self.on_expired:
+                self.on_expired(user_ids)
+        return user_ids
+
+    def claim_reminders(self, now):
+        """Mark due reminders as sent for the current subscription_end and return their user ids.
+
+        Claiming before sending keeps reminders at-most-once per subscription period, even with
+        several sweepers running.
+        """
+        rows = self.db.fetchall("UPDATE users SET reminded_end=subscription_end WHERE user_id IN "
+                                "(SELECT user_id FROM users WHERE payment_status='active' "
+                                "AND subscription_end > ? AND subscription_end <= ? "
+                                "AND (reminded_end IS NULL OR reminded_end != subscription_end) LIMIT ?) "
+                                "RETURNING user_id", (now, now + REMINDER_WINDOW, REMINDER_BATCH))
+        return [row[0] for row in rows]
+
+    def send_reminders(self, now):
+        user_ids = self.claim_reminders(now)
+        if user_ids:
+            result = self.engine.broadcast(user_ids, REMINDER_TEXT)
+            logger.info(f"Sent {result.sent} expiry reminders ({result.failed} failed)")
+        return len(user_ids)
+
+    def next_due(self, now):
+        """Seconds until the next expiry or reminder becomes due."""
+        next_expiry = self.db.fetchone("SELECT MIN(subscription_end) FROM users "
+                                       "WHERE payment_status='active'")[0]
+        next_reminder = self.db.fetchone("SELECT MIN(subscription_end) FROM users "
+                                         "WHERE payment_status='active' AND subscription_end > ?",
+                                         (now + REMINDER_WINDOW,))[0]
+        candidates = [t for t in (next_expiry, next_reminder and next_reminder - REMINDER_WINDOW) if t]
+        if not candidates:
+            return MAX_SLEEP
+        return min(MAX_SLEEP, max(1, min(candidates) - now))
+
+    def sweep(self):
+        """Run one pass; returns seconds to wait before the next one."""
+        now = int(time.time())
+        self.expire_due(now)
+        if self.send_reminders(now) >= REMINDER_BATCH:
+            return 0
+        return self.next_due(now)
+
+    def run_once(self):
+        return self.sweep()
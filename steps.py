@@ -0,0 +1,54 @@
+import json
+import logging
+import time
+
+from telebot import Handler
+from telebot.handler_backends import HandlerBackend
+
+logger = logging.getLogger(__name__)
+
+STEP_TTL = 24 * 3600  # seconds a pending next step stays valid
+
+
+class DatabaseHandlerBackend(HandlerBackend):
+    """Next-step handlers kept in the step_handlers table instead of process memory.
+
+    Any bot process can then receive the reply to a prompt another process sent.
+    Callbacks are stored by name and must be one of `callbacks`; their extra
+    args and kwargs must be JSON-serialisable.
+    """
+
+    def __init__(self, db, callbacks, ttl=STEP_TTL):
+        super().__init__()
+        self.db = db
+        self.callbacks = {callback.__name__: callback for callback in callbacks}
+        self.ttl = ttl
+
+    def register_handler(self, handler_group_id, handler):
+        name = handler.callback.__name__
+        if self.callbacks.get(name) is not handler.callback:
+            raise ValueError(f"Next-step callback {name} is not registered with the handler backend")
+        now = int(time.time())
+        self.db.execute("DELETE FROM step_handlers WHERE created_at < ?", (now - self.ttl,))
+        self.db.execute("INSERT INTO step_handlers (chat_id, callback, args, kwargs, created_at) VALUES (?, ?, ?, ?, ?)",
+                        (handler_group_id, name, json.dumps(handler.args), json.dumps(handler.kwargs), now))
+
+    def clear_handlers(self, handler_group_id):
+        self.db.execute("DELETE FROM step_handlers WHERE chat_id=?", (handler_group_id,))
+
+    def get_handlers(self, handler_group_id):
+        """Pop the chat's pending handlers. Called for every incoming message, so the common
+        no-pending-step case is a single indexed read."""
+        if not self.db.fetchone("SELECT 1 FROM step_handlers WHERE chat_id=? LIMIT 1", (handler_group_id,)):
+            return None
+        rows = self.db.fetchall("DELETE FROM step_handlers WHERE chat_id=? "
+                                "RETURNING step_id, callback, args, kwargs, created_at", (handler_group_id,))
+        cutoff = time.time() - self.ttl
+        handlers = []
+        for _, name, args, kwargs, created_at in sorted(rows):
+            callback = self.callbacks.get(name)
+            if callback is None or created_at < cutoff:
+                logger.warning(f"Dropping next step {name} for chat {handler_group_id}")
+                continue
+            handlers.append(Handler(callback, *json.loads(args), **json.loads(kwargs)))
+        return handlers or None
@@ -0,0 +1,103 @@
+import json
+import logging
+import queue
+import time
+
+from jobs import BackgroundJob
+
+logger = logging.getLogger(__name__)
+
+MAX_ATTEMPTS = 5
+RETRY_DELAY = 30  # seconds before a failed event is retried
+STALE_PROCESSING = 600  # seconds before a 'processing' event left by a dead process is re-queued
+RESCAN_INTERVAL = 30  # seconds between scans of the ledger for events to retry or take over
+
+
+class StripeEventQueue(BackgroundJob):
+    """Idempotent ledger and background consumer for Stripe webhook events.
+
+    record() inserts the event id into stripe_events and reports whether it was new;
+    duplicates are rejected by the primary key without touching anything else. New
+    events are handed to an in-process queue and applied by a consumer thread, which
+    claims each event (queued -> processing) before calling its handler so that an
+    event is applied once even if several processes pick it up. Failed and abandoned
+    events are found again by a periodic scan of the ledger, so retries survive the
+    process that first tried them.
+    """
+
+    thread_name = 'stripe-events'
+    title = 'Stripe event consumer'
+
+    def __init__(self, db, handlers=None):
+        super().__init__()
+        self.db = db
+        self.handlers = handlers or {}
+        self.pending = queue.Queue()
+        self.next_scan = 0
+
+    def record(self, event):
+        """Store the event if its id is new. Returns False for a duplicate delivery."""
+        row = self.db.fetchone("INSERT INTO stripe_events (event_id, type, payload, status, attempts, received_at) "
+                               "VALUES (?, ?, ?, 'queued', 0, ?) ON CONFLICT (event_id) DO NOTHING RETURNING event_id",
+                               (event['id'], event['type'], json.dumps(event), int(time.time())))
+        if row is None:
+            logger.info(f"Ignoring duplicate Stripe event {event['id']}")
+            return False
+        self.pending.put(event['id'])
+        return True
+
+    def claim(self, event_id):
+        """Move a queued event to processing. Returns its payload, or None if someone else owns it."""
+        with self.db.transaction():
+            claimed = self.db.execute("UPDATE stripe_events SET status='processing', claimed_at=?, attempts=attempts+1 "
+                                      "WHERE event_id=? AND status='queued'", (int(time.time()), event_id))
+            if not claimed:
+                return None
+            return json.loads(self.db.fetchone("SELECT payload FROM stripe_events WHERE event_id=?", (event_id,))[0])
+
+    def process(self, event_id):
+        event = self.claim(event_id)
+        if event is None:
+            return
+        handler = self.handlers.get(event['type'])
+        try:
+            if handler:
+                handler(event)
+            self.db.execute("UPDATE stripe_events SET status='processed', processed_at=?, error=NULL WHERE event_id=?",
+                            (int(time.time()), event_id))
+        except Exception as e:
+            logger.error(f"Error processing Stripe event {event_id}: {e}")
+            attempts = self.db.fetchone("SELECT attempts FROM stripe_events WHERE event_id=?", (event_id,))[0]
+            status = 'failed' if attempts >= MAX_ATTEMPTS else 'queued'
+            self.db.execute("UPDATE stripe_events SET status=?, error=? WHERE event_id=?", (status, str(e), event_id))
+
+    def requeue_unfinished(self):
+        """Queue events nobody is working on: queued ones not tried in the last RETRY_DELAY seconds,
+        and processing ones whose owner died."""
+        now = int(time.time())
+        self.db.execute("UPDATE stripe_events SET status='queued' WHERE status='processing' AND claimed_at < ?",
+                        (now - STALE_PROCESSING,))
+        rows = self.db.fetchall("SELECT event_id FROM stripe_events WHERE status='queued' "
+                                "AND (claimed_at IS NULL OR claimed_at < ?) ORDER BY received_at", (now - RETRY_DELAY,))
+        for (event_id,) in rows:
+            self.pending.put(event_id)
+        if rows:
+            logger.info(f"Re-queued {len(rows)} unfinished Stripe events")
+
+    def run_once(self):
+        """Apply the next queued event, waiting up to a second for one; rescans the ledger when due."""
+        if time.monotonic() >= self.next_scan:
+            try:
+                self.requeue_unfinished()
+            except Exception as e:
+                logger.error(f"Error scanning Stripe events: {e}")
+            self.next_scan = time.monotonic() + RESCAN_INTERVAL
+        try:
+            event_id = self.pending.get(timeout=1)
+        except queue.Empty:
+            return 0
+        try:
+            self.process(event_id)
+        except Exception as e:
+            logger.error(f"Stripe event consumer error for {event_id}: {e}")
+        return 0
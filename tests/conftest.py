@@ -0,0 +1,18 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db as database  # noqa: E402
+import migrations  # noqa: E402
+
+
+@pytest.fixture
+def db(tmp_path):
+    """A fully migrated SQLite database in a temporary directory."""
+    db = database.connect(f"sqlite:///{tmp_path / 'users.db'}")
+    migrations.migrate(db)
+    yield db
+    db.close()
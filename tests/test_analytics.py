@@ -0,0 +1,44 @@
+import time
+
+from analytics import Analytics, day_of
+
+
+def stats(db):
+    return {(kind, plan): (events, cents) for _, kind, plan, events, cents
+            in db.fetchall("SELECT day, kind, plan, events, amount_cents FROM daily_stats")}
+
+
+def test_roll_up_folds_each_event_once(db):
+    analytics = Analytics(db)
+    analytics.record('payment', 1, plan='week', days=7, amount_cents=5000)
+    analytics.record('payment', 2, plan='week', days=7, amount_cents=5000)
+    analytics.record('manual', [3, 4], days=3)
+    assert analytics.roll_up() == 4
+    assert analytics.roll_up() == 0
+    assert stats(db) == {('payment', 'week'): (2, 10000), ('manual', ''): (2, 0)}
+
+
+def test_roll_up_picks_up_events_committed_out_of_id_order(db):
+    # On Postgres an event can commit after a pass has already seen a higher event_id
+    analytics = Analytics(db)
+    now = int(time.time())
+    db.execute("INSERT INTO subscription_events (event_id, kind, user_id, created_at) VALUES (100, 'expired', 1, ?)",
+               (now,))
+    analytics.roll_up()
+    db.execute("INSERT INTO subscription_events (event_id, kind, user_id, created_at) VALUES (50, 'expired', 2, ?)",
+               (now,))
+    assert analytics.roll_up() == 1
+    assert stats(db) == {('expired', ''): (2, 0)}
+
+
+def test_summary_windows(db):
+    analytics = Analytics(db)
+    now = int(time.time())
+    today = day_of(now)
+    db.executemany("INSERT INTO daily_stats (day, kind, plan, events, amount_cents) VALUES (?, 'payment', 'week', ?, ?)",
+                   [(today, 1, 5000), (today - 3, 2, 10000), (today - 20, 4, 20000), (today - 40, 8, 40000)])
+    analytics.roll_up()
+    summary = analytics.summary(now)
+    totals = {label: window[('payment', 'week')] for label, window in summary['windows']}
+    assert totals == {'Today': (1, 5000), '7 days': (3, 15000), '30 days': (7, 35000)}
+    assert summary['snapshot'][:2] == (0, 0)
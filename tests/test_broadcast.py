@@ -0,0 +1,85 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from broadcast import BroadcastEngine, BroadcastQueue, TokenBucket
+
+
+def count_acquired(bucket, seconds):
+    count, deadline = 0, time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        bucket.acquire()
+        count += 1
+    return count
+
+
+def test_bucket_starts_with_a_full_burst():
+    bucket = TokenBucket(30)
+    assert count_acquired(bucket, 0.01) >= 30
+
+
+def test_pause_blocks_until_it_ends():
+    bucket = TokenBucket(30)
+    bucket.pause(0.2)
+    started = time.monotonic()
+    bucket.acquire()
+    assert time.monotonic() - started >= 0.2
+
+
+def test_no_burst_after_pause():
+    # A 429 pause must not be counted as idle refill time, or the bucket would release a
+    # full burst right after it and trigger the next 429
+    bucket = TokenBucket(30)
+    count_acquired(bucket, 0.01)
+    bucket.pause(0.3)
+    bucket.acquire()
+    assert count_acquired(bucket, 0.1) <= 5
+
+
+class FakeBot:
+    def __init__(self):
+        self.edits = []
+
+    def edit_message_text(self, text, chat_id, message_id):
+        self.edits.append(text)
+
+
+def make_queue(db, send):
+    engine = BroadcastEngine(send, global_rate=1000, per_chat_rate=1000)
+    return BroadcastQueue(db, engine, FakeBot())
+
+
+def test_each_recipient_recorded_as_it_is_sent(db):
+    recorded = []
+
+    def send(chat_id, text):
+        # Every earlier send has already been written back by the time the next one starts
+        recorded.append(db.fetchone("SELECT COUNT(*) FROM broadcast_recipients WHERE state='sent'")[0])
+        if chat_id == 3:
+            raise RuntimeError("blocked by user")
+
+    queue = make_queue(db, send)
+    queue.engine.executor = ThreadPoolExecutor(max_workers=1)
+    job_id = queue.enqueue("picks", [1, 2, 3, 4])
+    queue.drain_once()
+    assert recorded == [0, 1, 2, 2]
+    assert queue.job_counts(job_id) == {'sent': 3, 'failed': 1}
+
+
+def test_startup_finishes_jobs_left_in_sending(db):
+    sent = []
+    queue = make_queue(db, lambda chat_id, text: sent.append((chat_id, text)))
+    job_id = queue.enqueue("picks", [1, 2], admin_chat_id=99)
+    # Crash after every row was recorded but before the job was reported
+    db.execute("UPDATE broadcast_recipients SET state='sent' WHERE job_id=?", (job_id,))
+    db.execute("UPDATE broadcast_jobs SET status='sending' WHERE job_id=?", (job_id,))
+    stop = threading.Event()
+    thread = queue.start(stop)
+    deadline = time.monotonic() + 5
+    while db.fetchone("SELECT status FROM broadcast_jobs WHERE job_id=?", (job_id,))[0] != 'done':
+        assert time.monotonic() < deadline
+        time.sleep(0.05)
+    stop.set()
+    queue.wakeup.set()
+    thread.join(5)
+    assert sent and sent[0][0] == 99
@@ -0,0 +1,27 @@
+import pytest
+
+import bulk
+from bulk import BulkImportError
+
+
+def test_parse_activations_skips_header_and_blank_lines():
+    text = "user_id,days\n\n101, 7\n102,30\n101,14\n"
+    assert bulk.parse_activations(text) == {101: 14, 102: 30}
+
+
+def test_parse_activations_reports_every_bad_line():
+    with pytest.raises(BulkImportError) as error:
+        bulk.parse_activations("101,7\n102\n103,abc\n104,0\n")
+    assert [line.split(':')[0] for line in error.value.errors] == ['Line 2', 'Line 3', 'Line 4']
+
+
+def test_parse_removals_dedupes_and_ignores_extra_columns():
+    assert bulk.parse_removals("user_id,first_name\n101,Ann\n102\n101,Ann\n") == [101, 102]
+    with pytest.raises(BulkImportError):
+        bulk.parse_removals("101\nbob\n")
+
+
+def test_row_limit(monkeypatch):
+    monkeypatch.setattr(bulk, 'MAX_ROWS', 2)
+    with pytest.raises(BulkImportError):
+        bulk.parse_removals("1\n2\n3\n")
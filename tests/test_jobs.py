@@ -0,0 +1,40 @@
+import threading
+
+from jobs import BackgroundJob
+
+
+class CountingJob(BackgroundJob):
+    interval = 60
+
+    def __init__(self, results):
+        super().__init__()
+        self.results = list(results)
+        self.passes = threading.Semaphore(0)
+        self.stopped_calls = 0
+
+    def run_once(self):
+        self.passes.release()
+        result = self.results.pop(0) if self.results else None
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def stopped(self):
+        self.stopped_calls += 1
+
+
+def test_job_runs_again_at_once_survives_errors_and_stops_on_wakeup():
+    job = CountingJob([0, 0, RuntimeError("boom")])
+    stop = threading.Event()
+    thread = job.start(stop)
+    for _ in range(3):
+        assert job.passes.acquire(timeout=5)
+    # The error leaves the job waiting out its interval; a wakeup runs the next pass
+    assert not job.passes.acquire(timeout=0.2)
+    job.wakeup.set()
+    assert job.passes.acquire(timeout=5)
+    stop.set()
+    job.wakeup.set()
+    thread.join(timeout=5)
+    assert not thread.is_alive()
+    assert job.stopped_calls == 1
@@ -0,0 +1,78 @@
+import threading
+import time
+
+from leases import LeaderLease, LeaderOnly
+
+
+class FakeService:
+    """Records each term it is started for; the thread runs until the term ends."""
+
+    def __init__(self):
+        self.wakeup = threading.Event()
+        self.terms = []
+
+    def start(self, stop_event):
+        self.terms.append(stop_event)
+        thread = threading.Thread(target=stop_event.wait, daemon=True)
+        thread.start()
+        return thread
+
+    @property
+    def running(self):
+        return bool(self.terms) and not self.terms[-1].is_set()
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.02)
+
+
+def test_one_holder_until_the_lease_expires(db):
+    first = LeaderLease(db, 'sweeper', holder='a')
+    second = LeaderLease(db, 'sweeper', holder='b')
+    assert first.acquire()
+    assert not second.acquire()
+    assert first.acquire()  # renewing
+    db.execute("UPDATE leases SET expires_at=? WHERE name='sweeper'", (int(time.time()) - 1,))
+    assert second.acquire()
+    assert not first.acquire()
+
+
+def test_released_lease_is_free(db):
+    first = LeaderLease(db, 'sweeper', holder='a')
+    assert first.acquire()
+    first.release()
+    assert LeaderLease(db, 'sweeper', holder='b').acquire()
+
+
+def test_standby_takes_over_when_the_leader_stops(db):
+    services = [FakeService(), FakeService()]
+    stops = [threading.Event(), threading.Event()]
+    threads = [LeaderOnly(db, 'sweeper', service, renew_interval=0.05).start(stop)
+               for service, stop in zip(services, stops)]
+    wait_for(lambda: any(service.running for service in services))
+    leader = 0 if services[0].running else 1
+    standby = 1 - leader
+    time.sleep(0.2)
+    assert not services[standby].terms
+    stops[leader].set()
+    threads[leader].join(timeout=5)
+    assert not services[leader].running
+    wait_for(lambda: services[standby].running)
+    stops[standby].set()
+    threads[standby].join(timeout=5)
+    assert not services[standby].running
+    assert db.fetchone("SELECT COUNT(*) FROM leases")[0] == 0
+
+
+def test_leader_stops_its_service_when_the_lease_is_taken(db):
+    service = FakeService()
+    stop = threading.Event()
+    thread = LeaderOnly(db, 'sweeper', service, renew_interval=0.05).start(stop)
+    wait_for(lambda: service.running)
+    db.execute("UPDATE leases SET holder='other', expires_at=? WHERE name='sweeper'", (int(time.time()) + 60,))
+    wait_for(lambda: not service.running)
+    stop.set()
+    thread.join(timeout=5)
@@ -0,0 +1,53 @@
+import sqlite3
+from datetime import datetime
+
+import pytest
+
+import db as database
+import migrations
+
+
+@pytest.fixture
+def baseline_db(tmp_path):
+    """A users.db as the pre-migration bot created it, with subscription_end stored as text."""
+    path = str(tmp_path / 'users.db')
+    conn = sqlite3.connect(path)
+    conn.execute('''CREATE TABLE users
+                    (user_id INTEGER PRIMARY KEY,
+                     subscription_end TEXT,
+                     payment_status TEXT,
+                     payment_link TEXT,
+                     referral_code TEXT,
+                     referred_by INTEGER)''')
+    conn.executemany("INSERT INTO users VALUES (?, ?, ?, ?, ?, ?)", [
+        (1, '2030-01-02 03:04:05', 'active', 'https://pay/1', 'REF1', None),
+        (2, 'not a date', 'active', None, None, 1),
+        (3, None, 'pending', 'https://pay/3', None, None),
+    ])
+    conn.commit()
+    conn.close()
+    db = database.connect(f"sqlite:///{path}")
+    yield db
+    db.close()
+
+
+def test_migrate_reaches_latest_version(baseline_db):
+    assert migrations.migrate(baseline_db) == migrations.MIGRATIONS[-1][0]
+    # Running again is a no-op
+    assert migrations.migrate(baseline_db) == migrations.MIGRATIONS[-1][0]
+
+
+def test_subscription_end_converted_to_epoch(baseline_db):
+    migrations.migrate(baseline_db)
+    rows = dict(baseline_db.fetchall("SELECT user_id, subscription_end FROM users"))
+    assert rows[1] == int(datetime(2030, 1, 2, 3, 4, 5).timestamp())
+    assert rows[2] is None
+    assert rows[3] is None
+    column_types = {row[1]: row[2] for row in baseline_db.fetchall("PRAGMA table_info(users)")}
+    assert column_types['subscription_end'] == 'INTEGER'
+
+
+@pytest.mark.parametrize('sql, index', migrations.EXPECTED_PLANS)
+def test_hot_queries_use_their_index(baseline_db, sql, index):
+    migrations.migrate(baseline_db)
+    assert index in migrations.query_plan(baseline_db, sql)
@@ -0,0 +1,59 @@
+import time
+
+import bulk
+from broadcast import BroadcastEngine
+from referrals import ReferralEngine
+
+
+def make_engine(db, sent):
+    engine = BroadcastEngine(lambda chat_id, text: sent.append(chat_id), global_rate=1000, per_chat_rate=1000)
+    return ReferralEngine(db, engine, bonus_days=3)
+
+
+def subscription(db, user_id):
+    return db.fetchone('user_subscription', (user_id,))
+
+
+def refer(referrals, referrer, referred):
+    code = referrals.code_for(referrer)
+    assert referrals.join(referred, code) == referrer
+    assert referrals.record_conversion(referred)
+
+
+def test_pending_referrer_banks_bonus_until_payment(db):
+    referrals = make_engine(db, [])
+    now = int(time.time())
+    db.execute('upsert_pending', (1, 'pending', 'https://checkout/1', 'week', now + 3600))
+    refer(referrals, 1, 2)
+    assert referrals.accrue() == {1: 3}
+    end, status = subscription(db, 1)
+    assert status == 'pending' and (end is None or end <= now)
+    # The checkout completes: 7 paid days plus the 3 banked ones
+    ends = bulk.activate_many(db, {1: 7}, payment_link='https://checkout/1')
+    assert abs(ends[1] - (now + 10 * 86400)) < 5
+    assert subscription(db, 1) == (ends[1], 'active')
+    assert db.fetchone("SELECT bonus_days FROM users WHERE user_id=1")[0] == 0
+
+
+def test_bonus_extends_running_subscription(db):
+    referrals = make_engine(db, [])
+    end = bulk.activate_many(db, {1: 7})[1]
+    refer(referrals, 1, 2)
+    refer(referrals, 1, 3)
+    assert referrals.accrue() == {1: 6}
+    assert subscription(db, 1) == (end + 6 * 86400, 'active')
+    # Paying again adds to the end rather than restarting from now
+    assert bulk.activate_many(db, {1: 7})[1] == end + 13 * 86400
+
+
+def test_accrue_rewards_conversions_committed_out_of_id_order(db):
+    # On Postgres a conversion can commit after a pass has already seen a higher event_id
+    referrals = make_engine(db, [])
+    now = int(time.time())
+    db.execute("INSERT INTO referral_events (event_id, kind, referrer_id, referred_id, created_at) "
+               "VALUES (100, 'converted', 1, 2, ?)", (now,))
+    assert referrals.accrue() == {1: 3}
+    db.execute("INSERT INTO referral_events (event_id, kind, referrer_id, referred_id, created_at) "
+               "VALUES (50, 'converted', 1, 3, ?)", (now,))
+    assert referrals.accrue() == {1: 3}
+    assert referrals.accrue() == {}
@@ -0,0 +1,69 @@
+from types import SimpleNamespace
+
+from router import CallbackContext, CallbackRouter
+
+
+def context(data, user_id=5, admin_id=1, subscribed=False):
+    checks = []
+
+    def check(user_id):
+        checks.append(user_id)
+        return subscribed
+
+    call = SimpleNamespace(data=data, from_user=SimpleNamespace(id=user_id))
+    return CallbackContext(call, admin_id, check), checks
+
+
+def test_exact_match_wins_then_longest_prefix():
+    router = CallbackRouter()
+    seen = []
+
+    @router.route('plan_week')
+    def week(ctx):
+        seen.append('week')
+
+    @router.route(prefix='plan_')
+    def any_plan(ctx):
+        seen.append('any_plan')
+
+    @router.route(prefix='plan_vip_')
+    def vip_plan(ctx):
+        seen.append('vip_plan')
+
+    for data in ['plan_week', 'plan_month', 'plan_vip_year']:
+        ctx, _ = context(data)
+        assert router.dispatch(ctx)
+    assert seen == ['week', 'any_plan', 'vip_plan']
+    assert ctx.route == 'vip_plan'
+    assert not router.dispatch(context('unknown')[0])
+
+
+def test_middleware_runs_in_order_and_can_short_circuit():
+    order = []
+
+    def outer(ctx, handler):
+        order.append('outer')
+        handler(ctx)
+
+    def admin_only(ctx, handler):
+        order.append('admin_only')
+        if ctx.is_admin:
+            handler(ctx)
+
+    router = CallbackRouter()
+
+    @router.route('stats', middleware=(outer, admin_only))
+    def stats(ctx):
+        order.append('stats')
+
+    router.dispatch(context('stats', user_id=1)[0])
+    assert order == ['outer', 'admin_only', 'stats']
+    order.clear()
+    router.dispatch(context('stats', user_id=5)[0])
+    assert order == ['outer', 'admin_only']
+
+
+def test_subscription_checked_once_per_callback():
+    ctx, checks = context('vip', subscribed=True)
+    assert ctx.subscribed and ctx.subscribed
+    assert checks == [5]
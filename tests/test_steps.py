@@ -0,0 +1,47 @@
+import pytest
+from telebot import Handler
+
+from steps import DatabaseHandlerBackend
+
+
+def ask_amount(message, plan, retries=0):
+    return message, plan, retries
+
+
+def unregistered(message):
+    return message
+
+
+def test_handlers_round_trip_between_processes(db):
+    DatabaseHandlerBackend(db, [ask_amount]).register_handler(42, Handler(ask_amount, 'week', retries=2))
+    other = DatabaseHandlerBackend(db, [ask_amount])
+    handlers = other.get_handlers(42)
+    assert len(handlers) == 1
+    assert handlers[0].callback is ask_amount
+    assert handlers[0].args == ('week',)
+    assert handlers[0].kwargs == {'retries': 2}
+    # Popped: the next message in the chat is handled normally
+    assert other.get_handlers(42) is None
+
+
+def test_expired_handlers_are_dropped(db):
+    backend = DatabaseHandlerBackend(db, [ask_amount], ttl=60)
+    backend.register_handler(42, Handler(ask_amount, 'week'))
+    db.execute("UPDATE step_handlers SET created_at=created_at - 120")
+    assert backend.get_handlers(42) is None
+
+
+def test_unregistered_callback_is_rejected(db):
+    backend = DatabaseHandlerBackend(db, [ask_amount])
+    with pytest.raises(ValueError):
+        backend.register_handler(42, Handler(unregistered))
+    assert db.fetchone("SELECT COUNT(*) FROM step_handlers")[0] == 0
+
+
+def test_clear_handlers(db):
+    backend = DatabaseHandlerBackend(db, [ask_amount])
+    backend.register_handler(42, Handler(ask_amount, 'week'))
+    backend.register_handler(43, Handler(ask_amount, 'month'))
+    backend.clear_handlers(42)
+    assert backend.get_handlers(42) is None
+    assert backend.get_handlers(43)[0].args == ('month',)
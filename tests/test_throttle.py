@@ -0,0 +1,26 @@
+from throttle import InFlightDeduper, KeyedRateLimiter
+
+
+def test_rate_limiter_allows_a_burst_per_key(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr('throttle.time.monotonic', lambda: now[0])
+    limiter = KeyedRateLimiter(rate=1.0, burst=3)
+    assert [limiter.allow(1) for _ in range(4)] == [True, True, True, False]
+    assert limiter.allow(2)  # other users have their own bucket
+    now[0] += 1.0
+    assert limiter.allow(1)
+    assert not limiter.allow(1)
+
+
+def test_deduper_coalesces_running_and_recent_keys(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr('throttle.time.monotonic', lambda: now[0])
+    deduper = InFlightDeduper(window=2.0)
+    assert deduper.begin((1, 'vip'))
+    assert not deduper.begin((1, 'vip'))
+    assert deduper.begin((2, 'vip'))
+    deduper.end((1, 'vip'))
+    now[0] += 1.0
+    assert not deduper.begin((1, 'vip'))
+    now[0] += 1.5
+    assert deduper.begin((1, 'vip'))
@@ -0,0 +1,54 @@
+import threading
+import time
+import types
+
+from transport import UpdateDispatcher, poll_updates
+
+
+class FakeBot:
+    """Serves two batches of updates from getUpdates, then stops the poller."""
+
+    def __init__(self, stop_event):
+        self.stop_event = stop_event
+        self.batches = [[types.SimpleNamespace(update_id=i) for i in range(1, 4)],
+                        [types.SimpleNamespace(update_id=4)]]
+        self.offsets = []
+        self.handled = []
+        self.running = 0
+        self.max_running = 0
+        self.lock = threading.Lock()
+
+    def get_updates(self, offset=None, timeout=20, long_polling_timeout=20):
+        self.offsets.append(offset)
+        if not self.batches:
+            self.stop_event.set()
+            return []
+        return self.batches.pop(0)
+
+    def process_new_updates(self, updates):
+        with self.lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        time.sleep(0.05)
+        with self.lock:
+            self.running -= 1
+            self.handled.extend(update.update_id for update in updates)
+
+
+def test_polled_updates_run_concurrently_on_the_dispatcher():
+    stop = threading.Event()
+    bot = FakeBot(stop)
+    dispatcher = UpdateDispatcher(bot, max_workers=4)
+    poll_updates(bot, dispatcher, stop)
+    dispatcher.shutdown()
+    assert sorted(bot.handled) == [1, 2, 3, 4]
+    assert bot.offsets == [None, 4, 5]
+    assert bot.max_running > 1
+
+
+def test_full_backlog_rejects_without_blocking():
+    bot = FakeBot(threading.Event())
+    dispatcher = UpdateDispatcher(bot, max_workers=1, max_pending=1)
+    assert dispatcher.submit(types.SimpleNamespace(update_id=1))
+    assert not dispatcher.submit(types.SimpleNamespace(update_id=2))
+    dispatcher.shutdown()
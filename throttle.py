@@ -0,0 +1,56 @@
+import threading
+import time
+
+CALLBACK_RATE = 1.0  # callbacks per second per user, sustained
+CALLBACK_BURST = 5
+DEDUPE_WINDOW = 2.0  # seconds an identical callback is coalesced after the previous one finished
+
+
+class KeyedRateLimiter:
+    """Non-blocking token bucket per key (e.g. user_id)."""
+
+    def __init__(self, rate=CALLBACK_RATE, burst=CALLBACK_BURST):
+        self.rate = rate
+        self.burst = burst
+        self.buckets = {}  # key -> (tokens, updated)
+        self.lock = threading.Lock()
+
+    def allow(self, key):
+        now = time.monotonic()
+        with self.lock:
+            tokens, updated = self.buckets.get(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            allowed = tokens >= 1
+            self.buckets[key] = (tokens - 1 if allowed else tokens, now)
+            if len(self.buckets) > 10000:
+                # Buckets idle long enough to be full again carry no state worth keeping
+                idle = self.burst / self.rate
+                self.buckets = {k: v for k, v in self.buckets.items() if now - v[1] < idle}
+            return allowed
+
+
+class InFlightDeduper:
+    """Coalesces repeats of the same key while it is running or shortly after it finished."""
+
+    def __init__(self, window=DEDUPE_WINDOW):
+        self.window = window
+        self.in_flight = set()
+        self.finished = {}  # key -> monotonic time it finished
+        self.lock = threading.Lock()
+
+    def begin(self, key):
+        """Return True if the caller should run `key`, False if it duplicates a running or recent one."""
+        now = time.monotonic()
+        with self.lock:
+            if key in self.in_flight or now - self.finished.get(key, float('-inf')) < self.window:
+                return False
+            self.in_flight.add(key)
+            return True
+
+    def end(self, key):
+        now = time.monotonic()
+        with self.lock:
+            self.in_flight.discard(key)
+            self.finished[key] = now
+            if len(self.finished) > 10000:
+                self.finished = {k: t for k, t in self.finished.items() if now - t < self.window}
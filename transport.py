@@ -0,0 +1,91 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from telebot import apihelper
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+UPDATE_WORKERS = 8
+MAX_PENDING_PER_WORKER = 4  # queued updates per worker before the webhook answers 503
+
+REQUEST_SECONDS = metrics.histogram('telegram_request_seconds', 'Telegram Bot API request latency by method')
+REQUEST_ERRORS = metrics.counter('telegram_request_errors_total', 'Telegram Bot API requests that failed or returned non-200')
+
+
+class UpdateDispatcher:
+    """Bounded worker pool that runs Telegram updates received on the webhook.
+
+    submit() never blocks the HTTP request: when every worker is busy and the
+    backlog is full it returns False, the route answers 503 and Telegram
+    redelivers the update later.
+    """
+
+    def __init__(self, bot, max_workers=UPDATE_WORKERS, max_pending=None):
+        self.bot = bot
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='telegram-update')
+        self.slots = threading.BoundedSemaphore(max_pending or max_workers * MAX_PENDING_PER_WORKER)
+
+    def submit(self, update, block=False):
+        """Queue the update for a worker. Returns False when the backlog is full (or, with
+        block=True, waits for room instead)."""
+        if not self.slots.acquire(blocking=block):
+            logger.warning(f"Update queue full, rejecting update {update.update_id}")
+            return False
+        try:
+            self.executor.submit(self.process, update)
+        except RuntimeError:
+            # Executor already shut down
+            self.slots.release()
+            return False
+        return True
+
+    def process(self, update):
+        try:
+            self.bot.process_new_updates([update])
+        except Exception as e:
+            logger.error(f"Error processing update {update.update_id}: {e}")
+        finally:
+            self.slots.release()
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+
+def poll_updates(bot, dispatcher, stop_event, timeout=20):
+    """Long-poll getUpdates and run each update on `dispatcher` until `stop_event` is set.
+
+    Used when a client built for webhook delivery (threaded=False, updates run on the
+    dispatcher's pool) has to fall back to polling, so updates are still handled concurrently.
+    """
+    offset = None
+    while not stop_event.is_set():
+        try:
+            updates = bot.get_updates(offset=offset, timeout=timeout, long_polling_timeout=timeout)
+        except Exception as e:
+            logger.error(f"Error polling Telegram updates: {e}")
+            stop_event.wait(3)
+            continue
+        for update in updates:
+            dispatcher.submit(update, block=True)
+            offset = update.update_id + 1
+
+
+def timed_request_sender(method, url, **kwargs):
+    """apihelper.CUSTOM_REQUEST_SENDER that records latency per Bot API method (sendMessage, getUpdates...)."""
+    api_method = url.rsplit('/', 1)[-1]
+    with REQUEST_SECONDS.time(method=api_method):
+        try:
+            response = apihelper._get_req_session().request(method, url, **kwargs)
+        except Exception:
+            REQUEST_ERRORS.inc(method=api_method)
+            raise
+    if response.status_code != 200:
+        REQUEST_ERRORS.inc(method=api_method)
+    return response
+
+
+def instrument_telegram_requests():
+    apihelper.CUSTOM_REQUEST_SENDER = timed_request_sender
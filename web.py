@@ -0,0 +1,92 @@
+import hmac
+import logging
+import threading
+
+import telebot
+from flask import Blueprint, Flask, request
+
+import bot as core
+import metrics
+
+logger = logging.getLogger(__name__)
+
+webhooks = Blueprint('webhooks', __name__)
+telegram_updates = Blueprint('telegram_updates', __name__)
+observability = Blueprint('observability', __name__)
+
+# Webhook endpoint
+@webhooks.route('/webhook', methods=['POST'])
+def webhook():
+    stripe = core.get_stripe()
+    payload = request.data
+    sig_header = request.headers.get('Stripe-Signature')
+    try:
+        event = stripe.Webhook.construct_event(payload, sig_header, core.config.webhook_secret)
+    except (ValueError, stripe.error.SignatureVerificationError) as e:
+        logger.error(f"Webhook verification failed: {e}")
+        return 'Invalid request', 400
+
+    if event['type'] == 'checkout.session.completed':
+        if not (event['data']['object'].get('metadata') or {}).get('user_id'):
+            logger.error("No user_id in metadata")
+            return 'No user_id', 400
+
+    try:
+        core.stripe_events.record(event)
+    except Exception as e:
+        logger.error(f"Error recording Stripe event {event['id']}: {e}")
+        return 'Error', 500
+    return 'Success', 200
+
+@telegram_updates.route('/telegram', methods=['POST'])
+def telegram_webhook():
+    token = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+    if not hmac.compare_digest(token.encode(), core.config.telegram_webhook_secret.encode()):
+        return 'Forbidden', 403
+    try:
+        update = telebot.types.Update.de_json(request.get_data(as_text=True))
+    except Exception as e:
+        logger.error(f"Invalid Telegram update: {e}")
+        return 'Invalid update', 400
+    if not core.update_dispatcher.submit(update):
+        return 'Busy', 503
+    return 'OK', 200
+
+@observability.route('/metrics')
+def metrics_endpoint():
+    return metrics.render(), 200, {'Content-Type': 'text/plain; version=0.0.4'}
+
+@webhooks.route('/healthz')
+def healthz():
+    return 'OK', 200
+
+@webhooks.route('/readyz')
+def readyz():
+    if core.shutdown_event.is_set():
+        return 'Shutting down', 503
+    try:
+        core.db.fetchone("SELECT 1")
+    except Exception as e:
+        logger.error(f"Readiness check failed: {e}")
+        return 'Database unavailable', 503
+    return 'Ready', 200
+
+def serve_metrics(port):
+    """Expose /metrics from processes that don't serve the webhook app (bot, worker)."""
+    app = Flask(__name__)
+    app.register_blueprint(observability)
+    threading.Thread(target=lambda: app.run(host='0.0.0.0', port=port), name='metrics-server', daemon=True).start()
+
+def create_app(cfg=None):
+    """WSGI app factory: webhook routes plus the Stripe event consumer and picks reloader for this process."""
+    core.setup(cfg)
+    app = Flask(__name__)
+    app.register_blueprint(webhooks)
+    app.register_blueprint(observability)
+    if core.config.telegram_transport == 'webhook':
+        # Only accept Telegram updates over HTTP when that is the configured transport
+        app.register_blueprint(telegram_updates)
+    core.init_db()
+    # Webhook-mode updates are handled in this process, so its picks must follow publishes made elsewhere
+    core.start_background(core.stripe_events, core.picks_store)
+    return app